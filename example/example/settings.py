@@ -54,3 +54,18 @@ TEMPLATE_DIRS = (
     os.path.join(BASE_DIR, 'templates'),
 )
 STATIC_URL='/static/'
+
+# To try out read replica routing with a second SQLite database:
+#
+# DATABASES['replica'] = {
+#     'ENGINE': 'django.db.backends.sqlite3',
+#     'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# }
+# DATABASE_ROUTERS = ['timeslot_lottery.routers.LotteryRouter']
+# MIDDLEWARE_CLASSES.append('timeslot_lottery.routers.PinnedUserMiddleware')
+# TIMESLOT_LOTTERY_REPLICA = 'replica'
+
+# To store bids as one bit mask per user and week, run
+# `manage.py convert_bids --to bitmask` and set:
+#
+# TIMESLOT_LOTTERY_BID_STORAGE = 'bitmask'
@@ -3,5 +3,5 @@ from django.contrib import admin
 
 urlpatterns = patterns('',
     url(r'^admin/', include(admin.site.urls)),
-    url(r'^', include('timeslot_lottery.urls')),
+    url(r'^', include('timeslot_lottery.urls', namespace='timeslot_lottery')),
 )
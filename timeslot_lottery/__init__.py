@@ -0,0 +1 @@
+default_app_config = 'timeslot_lottery.apps.TimeslotLotteryConfig'
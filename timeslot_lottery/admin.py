@@ -1,8 +1,81 @@
 from django.contrib import admin
+from django.db.models import Count
 
 from timeslot_lottery import models
+from timeslot_lottery import notifications
 
 
-admin.site.register(models.Slot)
-admin.site.register(models.Template)
-admin.site.register(models.Week)
+class SlotInline(admin.TabularInline):
+    model = models.Slot
+    fields = ('time', 'capacity', 'winner')
+    raw_id_fields = ('winner',)
+    extra = 0
+
+    def get_queryset(self, request):
+        return (super(SlotInline, self).get_queryset(request)
+                .select_related('winner'))
+
+
+class SlotAdmin(admin.ModelAdmin):
+    list_display = ('time', 'week', 'capacity', 'winner', 'num_bids')
+    list_select_related = ('week', 'winner')
+    list_filter = ('week__template',)
+    date_hierarchy = 'time'
+    raw_id_fields = ('week', 'winner', 'bidders')
+    # Follows winner, see Slot.save
+    readonly_fields = ('winners',)
+
+    def get_queryset(self, request):
+        return (super(SlotAdmin, self).get_queryset(request)
+                .annotate(num_bids=Count('bidders')))
+
+    def num_bids(self, slot):
+        return slot.num_bids
+    num_bids.admin_order_field = 'num_bids'
+    num_bids.short_description = "bids"
+
+
+class WeekAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'template', 'status', 'auto_close_from',
+                    'num_slots', 'num_bids')
+    list_select_related = ('template',)
+    list_filter = ('status', 'template')
+    date_hierarchy = 'auto_close_from'
+    inlines = [SlotInline]
+    actions = ['close_weeks', 'notify_winners']
+
+    def get_queryset(self, request):
+        return (super(WeekAdmin, self).get_queryset(request)
+                .annotate(num_slots=Count('slots', distinct=True),
+                          num_bids=Count('slots__bidders')))
+
+    def num_slots(self, week):
+        return week.num_slots
+    num_slots.admin_order_field = 'num_slots'
+    num_slots.short_description = "slots"
+
+    def num_bids(self, week):
+        return week.num_bids
+    num_bids.admin_order_field = 'num_bids'
+    num_bids.short_description = "bids"
+
+    def close_weeks(self, request, queryset):
+        closed = list(models.Week.objects.iter_close(
+            queryset.values_list('pk', flat=True)))
+        self.message_user(request, "Closed {} weeks.".format(len(closed)))
+    close_weeks.short_description = "Close selected weeks and pick winners"
+
+    def notify_winners(self, request, queryset):
+        sent = notifications.notify_winners(queryset)
+        self.message_user(request, "Sent {} emails.".format(sent))
+    notify_winners.short_description = "Email the winners of selected weeks"
+
+
+class TemplateAdmin(admin.ModelAdmin):
+    list_display = ('title', 'slug', 'auto_opening', 'auto_closing')
+    prepopulated_fields = {'slug': ('title',)}
+
+
+admin.site.register(models.Slot, SlotAdmin)
+admin.site.register(models.Template, TemplateAdmin)
+admin.site.register(models.Week, WeekAdmin)
@@ -0,0 +1,307 @@
+"""
+Allocation of slots to bidders, without touching the database
+
+A week's bids are loaded once into a `BidGraph` where slots and bidders
+are plain integer indexes.  The allocators work on that graph only.  A
+slot may have room for several winners, but a bidder wins at most one
+slot.
+
+A `Snapshot` holds everything an allocation depends on, including the
+random seed, so a stored snapshot can be allocated again to verify a
+close.
+"""
+import collections
+import random
+
+
+class BidGraph(object):
+    """
+    Who bid for which slot, indexed by integers
+
+    Attributes:
+      slot_ids       Slot primary keys.  A slot's index is its position.
+      capacities     For every slot index, the number of free seats.
+      bidder_ids     User primary keys, sorted.  Same indexing as slots.
+      bidder_index   Dict from user primary key to bidder index.
+      slot_bidders   For every slot index, the set of bidder indexes.
+      bidder_slots   For every bidder index, the set of slot indexes.
+    """
+    def __init__(self, slot_ids, bid_pairs, capacities=None):
+        """
+        Build the graph from slot ids and (slot id, user id) pairs
+
+        Bids on slots not in `slot_ids` are ignored.  `capacities` is a
+        dict from slot id to free seats, slots not in it have one.
+        """
+        self.slot_ids = list(slot_ids)
+        capacities = capacities or {}
+        self.capacities = [capacities.get(pk, 1) for pk in self.slot_ids]
+        slot_index = dict((pk, i) for i, pk in enumerate(self.slot_ids))
+        bids = [(slot_index[slot_id], user_id)
+                for slot_id, user_id in bid_pairs
+                if slot_id in slot_index]
+        self.bidder_ids = sorted(set(user_id for _, user_id in bids))
+        self.bidder_index = dict(
+            (pk, i) for i, pk in enumerate(self.bidder_ids))
+        self.slot_bidders = [set() for _ in self.slot_ids]
+        self.bidder_slots = [set() for _ in self.bidder_ids]
+        for slot, user_id in bids:
+            bidder = self.bidder_index[user_id]
+            self.slot_bidders[slot].add(bidder)
+            self.bidder_slots[bidder].add(slot)
+
+    def least_wanted_first(self, slots):
+        """
+        The given slot indexes sorted by bids per seat, fewest first
+
+        Ties keep the order of `slots`.
+        """
+        return sorted(slots, key=lambda slot: (
+            len(self.slot_bidders[slot]) / float(self.capacities[slot])))
+
+
+def greedy(graph, open_slots, pick_order):
+    """
+    Fill the open slots first-come first-served
+
+    Bidders are served in `pick_order`, and each one gets a seat in the
+    least wanted open slot they bid for.  Once the seats are gone the
+    rest of the bidders get nothing.
+
+    Returns:
+      A list of (slot index, bidder index) pairs in pick order.
+    """
+    rank = dict((slot, r) for r, slot
+                in enumerate(graph.least_wanted_first(open_slots)))
+    seats = dict((slot, graph.capacities[slot]) for slot in rank)
+    won = []
+    for bidder in pick_order:
+        if not rank:
+            break
+        wanted = [slot for slot in graph.bidder_slots[bidder]
+                  if slot in rank]
+        if wanted:
+            slot = min(wanted, key=rank.__getitem__)
+            won.append((slot, bidder))
+            seats[slot] -= 1
+            if not seats[slot]:
+                del rank[slot]
+    return won
+
+
+def priority_flow(graph, open_slots, pick_order):
+    """
+    Fill as many seats of the open slots as possible
+
+    This is a min-cost flow from bidders through the slots they bid for
+    to the seats, where a bidder costs less the earlier they are in
+    `pick_order`, so the fairness tiers of the pick order are kept.
+    With costs that only depend on the bidder, the cheapest maximum flow
+    is found by adding bidders in pick order, each through an augmenting
+    path, which may move earlier bidders to other slots but never drops
+    them.  Each path search visits every slot at most once, so the
+    whole allocation is O(bidders * bids).
+
+    Returns:
+      A list of (slot index, bidder index) pairs in pick order.
+    """
+    rank = dict((slot, r) for r, slot
+                in enumerate(graph.least_wanted_first(open_slots)))
+    seats = dict((slot, graph.capacities[slot]) for slot in rank)
+    free_seats = sum(seats.values())
+    wanted = {}
+
+    def wanted_slots(bidder):
+        if bidder not in wanted:
+            wanted[bidder] = sorted(
+                (slot for slot in graph.bidder_slots[bidder]
+                 if slot in rank),
+                key=rank.__getitem__)
+        return wanted[bidder]
+
+    owners = collections.defaultdict(list)
+    # Slots seen by a failed search can never reach a free seat again
+    dead = set()
+    for bidder in pick_order:
+        if not free_seats:
+            break
+        free = [slot for slot in wanted_slots(bidder)
+                if len(owners[slot]) < seats[slot]]
+        if free:
+            owners[free[0]].append(bidder)
+            free_seats -= 1
+            continue
+        # Depth first search alternating between bidders and the full
+        # slots they could move out of.  Even positions of the stack are
+        # bidders, odd positions are the slots the next bidder sits in.
+        seen = set()
+        stack = [(bidder, iter(wanted_slots(bidder)))]
+        found = None
+        while stack and found is None:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+            elif len(stack) % 2 == 0:
+                # node is a full slot, child one of its bidders
+                stack.append((child, iter(wanted_slots(child))))
+            elif child not in seen and child not in dead:
+                seen.add(child)
+                if len(owners[child]) < seats[child]:
+                    found = child
+                else:
+                    stack.append((child, iter(list(owners[child]))))
+        if found is None:
+            dead.update(seen)
+            continue
+        # Every bidder on the path moves one slot along it
+        target = found
+        for i in range(len(stack) - 1, -1, -2):
+            moved = stack[i][0]
+            owners[target].append(moved)
+            if i:
+                target = stack[i - 1][0]
+                owners[target].remove(moved)
+        free_seats -= 1
+
+    position = dict((bidder, i) for i, bidder in enumerate(pick_order))
+    return sorted(((slot, bidder) for slot, bidders in owners.items()
+                   for bidder in bidders),
+                  key=lambda pair: position[pair[1]])
+
+
+# The flow with one seat per slot is a priority matching
+priority_matching = priority_flow
+
+
+GREEDY = 'greedy'
+MATCHING = 'matching'
+FLOW = 'flow'
+
+STRATEGIES = {
+    GREEDY: greedy,
+    MATCHING: priority_matching,
+    FLOW: priority_flow,
+}
+
+
+def allocate(strategy, graph, open_slots, pick_order):
+    """
+    Run the allocation strategy named `strategy`
+    """
+    try:
+        allocator = STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError("Unknown allocation strategy {!r}".format(strategy))
+    return allocator(graph, open_slots, pick_order)
+
+
+def pick_order(bidder_ids, win_counts, rng):
+    """
+    Bidders with the fewest wins first, shuffled among equal wins
+
+    Arguments:
+      bidder_ids  User ids of the bidders.
+      win_counts  Dict from user id to number of wins.  Missing users
+                  have no wins.
+      rng         A `random.Random` to shuffle with.  The result only
+                  depends on its state, not on the order of `bidder_ids`
+                  or the Python version.
+
+    Returns:
+      A list of user ids.
+    """
+    bidders_by_wins = collections.defaultdict(list)
+    # Group by number of wins
+    for bidder_id in sorted(bidder_ids):
+        bidders_by_wins[win_counts.get(bidder_id, 0)].append(bidder_id)
+    ordered_bidders = []
+    for wins in sorted(bidders_by_wins):
+        # Shuffle persons internally in each group
+        _shuffle(bidders_by_wins[wins], rng)
+        ordered_bidders.extend(bidders_by_wins[wins])
+    return ordered_bidders
+
+
+def _shuffle(items, rng):
+    """
+    Shuffle `items` in place, the same on every Python version
+
+    random.shuffle changed its algorithm in Python 3, so a stored seed
+    would give another pick order there.  This is the Fisher-Yates
+    shuffle of Python 2's random.shuffle, on `rng.random()`.
+    """
+    for i in reversed(range(1, len(items))):
+        j = int(rng.random() * (i + 1))
+        items[i], items[j] = items[j], items[i]
+
+
+class Snapshot(object):
+    """
+    The input of a week's allocation, as plain data
+
+    Attributes:
+      slot_ids       Slot ids of the week, in slot time order.
+      open_slot_ids  Ids of the slots with free seats.
+      bids           List of (slot id, user id) pairs.
+      win_counts     Dict from user id to number of earlier wins.
+      seed           Seed for the random pick order.
+      strategy       Name of the allocation strategy.
+      capacities     Dict from slot id to free seats, for the slots that
+                     don't have exactly one.
+    """
+    def __init__(self, slot_ids, open_slot_ids, bids, win_counts, seed,
+                 strategy=GREEDY, capacities=None):
+        self.slot_ids = list(slot_ids)
+        self.open_slot_ids = list(open_slot_ids)
+        self.bids = [tuple(bid) for bid in bids]
+        self.win_counts = dict(win_counts)
+        self.seed = seed
+        self.strategy = strategy
+        self.capacities = dict(capacities or {})
+
+    @property
+    def open_seats(self):
+        "Total number of free seats in the open slots"
+        return sum(self.capacities.get(slot_id, 1)
+                   for slot_id in self.open_slot_ids)
+
+    def to_json(self):
+        return {
+            'slots': self.slot_ids,
+            'open': self.open_slot_ids,
+            'bids': [list(bid) for bid in self.bids],
+            'wins': sorted(self.win_counts.items()),
+            'seed': self.seed,
+            'strategy': self.strategy,
+            'capacities': sorted(self.capacities.items()),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['slots'], data['open'], data['bids'],
+                   data['wins'], data['seed'], data['strategy'],
+                   data.get('capacities'))
+
+    def allocate(self):
+        """
+        Run the allocation
+
+        Returns:
+          A tuple of a list of (slot id, user id) pairs for the won slots
+          and a list of ids of the bidders who didn't win, both in pick
+          order.
+        """
+        graph = BidGraph(self.slot_ids, self.bids, self.capacities)
+        order = [graph.bidder_index[bidder_id] for bidder_id in pick_order(
+            graph.bidder_ids, self.win_counts, random.Random(self.seed))]
+        open_slots = set(self.open_slot_ids)
+        won = allocate(self.strategy, graph,
+                       [i for i, slot_id in enumerate(graph.slot_ids)
+                        if slot_id in open_slots],
+                       order)
+        winners = set(bidder for _, bidder in won)
+        return ([(graph.slot_ids[slot], graph.bidder_ids[bidder])
+                 for slot, bidder in won],
+                [graph.bidder_ids[bidder] for bidder in order
+                 if bidder not in winners])
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class TimeslotLotteryConfig(AppConfig):
+    name = 'timeslot_lottery'
+    verbose_name = "Timeslot lottery"
+
+    def ready(self):
+        if getattr(settings, 'TIMESLOT_LOTTERY_METRICS', False):
+            from timeslot_lottery import instrumentation
+            instrumentation.register(instrumentation.aggregator)
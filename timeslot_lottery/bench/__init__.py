@@ -0,0 +1,10 @@
+"""
+Benchmarks of the lottery's hot paths
+
+Run them with the lottery_bench management command.  Everything is
+created in a transaction that is rolled back afterwards.
+"""
+from timeslot_lottery.bench.runner import run_benchmarks
+
+
+__all__ = ['run_benchmarks']
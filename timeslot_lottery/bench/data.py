@@ -0,0 +1,88 @@
+"""
+Synthetic templates, weeks, users, bids and win histories
+"""
+import bisect
+
+from django.contrib.auth import get_user_model
+
+from timeslot_lottery.models import Template
+from timeslot_lottery.models import WinCount
+from timeslot_lottery.models import bid_storage
+
+
+DISTRIBUTIONS = ('uniform', 'skewed')
+
+
+def create_template(slug, num_slots, **kwargs):
+    """
+    Template with `num_slots` slots spread evenly over the week
+    """
+    minutes_apart = max(1, 24 * 60 // -(-num_slots // 7))
+    slots = dict((day, []) for day in range(1, 8))
+    for i in range(num_slots):
+        minute = (i // 7) * minutes_apart % (24 * 60)
+        slots[i % 7 + 1].append('{:02d}:{:02d}'.format(*divmod(minute, 60)))
+    return Template.objects.create(title=slug[:32], slug=slug, slots=slots,
+                                   **kwargs)
+
+
+def create_users(prefix, count):
+    """
+    Ids of `count` new users
+    """
+    User = get_user_model()
+    User.objects.bulk_create([
+        User(**{User.USERNAME_FIELD: '{}{}'.format(prefix, i)})
+        for i in range(count)])
+    return list(User.objects
+                .filter(**{User.USERNAME_FIELD + '__startswith': prefix})
+                .values_list('pk', flat=True))
+
+
+def create_bids(week, user_ids, bids_per_user, distribution, rng):
+    """
+    Let every user bid for `bids_per_user` slots of the week
+
+    With the skewed distribution the first slots are much more popular
+    than the last, like a Zipf distribution.
+    """
+    slot_ids = list(week.slots.values_list('pk', flat=True))
+    return bid_storage().replace_many(dict(
+        ((week.pk, user_id),
+         set(pick_slots(slot_ids, bids_per_user, distribution, rng)))
+        for user_id in user_ids))
+
+
+def create_win_history(template, user_ids, max_wins, rng):
+    """
+    Give the users between 0 and `max_wins` earlier wins in the template
+    """
+    WinCount.objects.bulk_create([
+        WinCount(template=template, user_id=user_id,
+                 count=rng.randint(0, max_wins))
+        for user_id in user_ids])
+
+
+def pick_slots(slot_ids, count, distribution, rng):
+    """
+    `count` different slot ids drawn with the given distribution
+    """
+    count = min(count, len(slot_ids))
+    if distribution == 'uniform':
+        return rng.sample(slot_ids, count)
+    if distribution != 'skewed':
+        raise ValueError("Unknown distribution {!r}".format(distribution))
+    weights = _accumulate(1.0 / (rank + 1) for rank in range(len(slot_ids)))
+    picked = set()
+    while len(picked) < count:
+        picked.add(bisect.bisect(weights, rng.random() * weights[-1]))
+    return [slot_ids[i] for i in picked]
+
+
+def _accumulate(values):
+    total = 0
+    sums = []
+    for value in values:
+        total += value
+        sums.append(total)
+    return sums
@@ -0,0 +1,160 @@
+"""
+Timing, query counting and memory measurement of the hot paths
+"""
+import datetime
+import random
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db import transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from timeslot_lottery import views
+from timeslot_lottery.bench import data
+from timeslot_lottery.models import Week
+
+
+BENCHMARKS = ('create_new_week', 'fill_slots', 'close', 'close_pending',
+              'week_detail_post')
+
+
+def run_benchmarks(names=BENCHMARKS, slots=100, users=1000,
+                   bids_per_user=5, distribution='uniform', max_wins=10,
+                   weeks=10, seed=0):
+    """
+    Run benchmarks on synthetic data, and roll all of it back
+
+    close_pending closes every pending week in the database, so run the
+    benchmarks against a database without other data.
+
+    Arguments:
+      names          Benchmarks to run, from BENCHMARKS.
+      slots          Slots per week.
+      users          Number of bidders.
+      bids_per_user  Slots every bidder bids for.
+      distribution   'uniform' or 'skewed' towards the first slots.
+      max_wins       Earlier wins per user are drawn from 0..max_wins.
+      weeks          Number of pending weeks for close_pending.
+      seed           Seed for the synthetic data.
+
+    Returns:
+      A list of dicts with the name, wall time in seconds, number of
+      queries and peak memory in KiB of every benchmark.
+    """
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError("Unknown benchmarks: {}".format(
+            ', '.join(sorted(unknown))))
+    if distribution not in data.DISTRIBUTIONS:
+        raise ValueError("Unknown distribution {!r}".format(distribution))
+    setup = _Setup(slots, users, bids_per_user, distribution, max_wins,
+                   weeks, random.Random(seed))
+    results = []
+    for name in names:
+        with transaction.atomic():
+            func = getattr(setup, name)()
+            results.append(measure(name, func))
+            transaction.set_rollback(True)
+    return results
+
+
+def measure(name, func):
+    """
+    Call `func` and measure it
+
+    Peak memory is measured with tracemalloc where it's available, and
+    is otherwise the peak resident size of the whole process.
+    tracemalloc slows everything down a bit, so compare timings only
+    between runs on the same Python.
+    """
+    if tracemalloc:
+        tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        start = time.time()
+        func()
+        seconds = time.time() - start
+    if tracemalloc:
+        peak_kib = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    elif resource:
+        peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    else:
+        peak_kib = None
+    return {
+        'name': name,
+        'seconds': seconds,
+        'queries': len(queries),
+        'peak_memory_kib': peak_kib,
+    }
+
+
+class _Setup(object):
+    """
+    Creates the data for a benchmark and returns what to measure
+    """
+    def __init__(self, slots, users, bids_per_user, distribution, max_wins,
+                 weeks, rng):
+        self.slots = slots
+        self.users = users
+        self.bids_per_user = bids_per_user
+        self.distribution = distribution
+        self.max_wins = max_wins
+        self.weeks = weeks
+        self.rng = rng
+
+    def _template(self):
+        template = data.create_template('bench-lottery', self.slots)
+        self.user_ids = data.create_users('bench-lottery-', self.users)
+        data.create_win_history(template, self.user_ids, self.max_wins,
+                                self.rng)
+        return template
+
+    def _week(self, template, week_no):
+        week = template.create_new_week((2000, week_no))
+        data.create_bids(week, self.user_ids, self.bids_per_user,
+                         self.distribution, self.rng)
+        return week
+
+    def create_new_week(self):
+        template = data.create_template('bench-lottery', self.slots)
+        return lambda: template.create_new_week((2000, 1))
+
+    def fill_slots(self):
+        week = self._week(self._template(), 1)
+        return week.fill_slots
+
+    def close(self):
+        week = self._week(self._template(), 1)
+        return week.close
+
+    def close_pending(self):
+        template = self._template()
+        for week_no in range(1, self.weeks + 1):
+            self._week(template, week_no)
+        Week.objects.filter(template=template).update(
+            auto_close_from=timezone.now() - datetime.timedelta(days=1))
+        return Week.objects.close_pending
+
+    def week_detail_post(self):
+        template = self._template()
+        week = template.create_new_week((2000, 1))
+        user = get_user_model().objects.get(pk=self.user_ids[0])
+        slot_ids = list(week.slots.values_list('pk', flat=True))
+        request = RequestFactory().post('/', dict(
+            ('slot-{}'.format(slot_id), 'on')
+            for slot_id in data.pick_slots(slot_ids, self.bids_per_user,
+                                           self.distribution, self.rng)))
+        request.user = user
+        return lambda: views.week_detail(request, template.slug, '2000', '01')
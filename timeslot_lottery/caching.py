@@ -0,0 +1,46 @@
+"""
+Versioned cache keys
+
+Cached data is stored under keys that include a version number.  Bumping
+the version makes all of it stale at once, without knowing the keys.
+"""
+import time
+
+from django.core.cache import cache
+
+
+def version(name):
+    """
+    Current version of the cached data called `name`
+    """
+    key = _version_key(name)
+    value = cache.get(key)
+    if value is None:
+        # Never start over at an old number, there may be entries left
+        cache.add(key, _new_version(), None)
+        value = cache.get(key)
+    return value
+
+
+def bump(*names):
+    """
+    Make everything cached under the given names stale
+    """
+    cache.set_many(dict((_version_key(name), _new_version())
+                        for name in names), None)
+
+
+def make_key(name, *parts):
+    """
+    Cache key for data called `name` that varies on `parts`
+    """
+    return ':'.join(['timeslot_lottery', name, str(version(name))] +
+                    [str(part) for part in parts])
+
+
+def _version_key(name):
+    return 'timeslot_lottery:version:{}'.format(name)
+
+
+def _new_version():
+    return int(time.time() * 1000000)
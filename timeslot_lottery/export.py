@@ -0,0 +1,132 @@
+"""
+Streaming export of a template's history
+
+Every slot of the template becomes one row, with its week, winners and
+bidders.  Slots are read in primary key order, `chunk_size` at a time,
+together with the wins and bids of just those slots, so an export uses
+the same memory however many weeks and bids there are.
+"""
+import csv
+import json
+
+from django.contrib.auth import get_user_model
+from django.utils import six
+
+from timeslot_lottery.models import Slot
+from timeslot_lottery.models import _chunks
+from timeslot_lottery.models import winner_relation
+from timeslot_lottery.models import bid_storage
+
+
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+FIELDS = ('year', 'week_no', 'status', 'slot_id', 'time', 'capacity',
+          'winner_ids', 'winners', 'bidder_ids', 'bidders')
+LIST_FIELDS = ('winner_ids', 'winners', 'bidder_ids', 'bidders')
+
+
+def rows(template, chunk_size=500):
+    """
+    Dicts with the FIELDS of every slot of the template
+    """
+    slots = (Slot.objects.filter(week__template=template).order_by('pk')
+             .values_list('pk', 'time', 'week__year', 'week__week_no',
+                          'week__status', 'capacity'))
+    last_pk = 0
+    while True:
+        chunk = list(slots.filter(pk__gt=last_pk)[:chunk_size].iterator())
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        slot_ids = [pk for pk, _, _, _, _, _ in chunk]
+        winners = _users_by_slot(winner_relation(), slot_ids)
+        bidders = _named_users(bid_storage().bidders(slot_ids))
+        for pk, time, year, week_no, status, capacity in chunk:
+            yield {
+                'year': year,
+                'week_no': week_no,
+                'status': status,
+                'slot_id': pk,
+                'time': time.isoformat(),
+                'capacity': capacity,
+                'winner_ids': [user_id for user_id, _ in winners[pk]],
+                'winners': [name for _, name in winners[pk]],
+                'bidder_ids': [user_id for user_id, _ in bidders[pk]],
+                'bidders': [name for _, name in bidders[pk]],
+            }
+
+
+def _users_by_slot(relation, slot_ids):
+    """
+    Dict from slot id to (user id, username) pairs related to the slot
+    """
+    through, slot_field, user_field = relation
+    username_field = get_user_model().USERNAME_FIELD
+    users = dict((pk, []) for pk in slot_ids)
+    for slot_id, user_id, name in (
+            through.objects
+            .filter(**{slot_field + '__in': slot_ids})
+            .order_by(slot_field, user_field)
+            .values_list(slot_field, user_field,
+                         user_field + '__' + username_field)
+            .iterator()):
+        users[slot_id].append((user_id, name))
+    return users
+
+
+def _named_users(user_ids_by_slot):
+    """
+    The user ids of every slot as (user id, username) pairs
+    """
+    User = get_user_model()
+    username_field = User.USERNAME_FIELD
+    user_ids = list(set(user_id for user_ids in user_ids_by_slot.values()
+                        for user_id in user_ids))
+    names = {}
+    for chunk in _chunks(user_ids):
+        names.update(User.objects.filter(pk__in=chunk)
+                     .values_list('pk', username_field))
+    return dict((slot_id, [(user_id, names[user_id]) for user_id in user_ids])
+                for slot_id, user_ids in user_ids_by_slot.items())
+
+
+def export(template, format='csv', chunk_size=500):
+    """
+    Lines of the template's history in `format`, one of FORMATS
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown export format {!r}".format(format))
+    lines = _csv_lines if format == 'csv' else _jsonl_lines
+    return lines(rows(template, chunk_size))
+
+
+def _jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row, sort_keys=True) + '\n'
+
+
+class _Echo(object):
+    "File-like object that returns what's written to it"
+    def write(self, value):
+        return value
+
+
+def _csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        row = dict(row, **dict(
+            (field, ' '.join(six.text_type(value) for value in row[field]))
+            for field in LIST_FIELDS))
+        yield writer.writerow([_csv_value(row[field]) for field in FIELDS])
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
@@ -0,0 +1,228 @@
+"""
+Measurements of the lottery's hot paths
+
+The hot paths run inside `instrument`.  When one finishes, every callback
+registered with `register` gets an `Event` with the time used, the number
+of queries, and numbers the code added such as bidders and fill rate.
+With no callbacks registered, `instrument` does next to nothing.
+
+Set TIMESLOT_LOTTERY_METRICS = True to register the default `aggregator`,
+which can be exported in the Prometheus text format.
+"""
+from contextlib import contextmanager
+import collections
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+_callbacks = []
+
+
+class Event(object):
+    """
+    A finished instrumented operation
+
+    Attributes:
+      name     Name of the operation, like 'allocation'.
+      seconds  Wall time used.
+      queries  Number of database queries made.
+      values   Dict of other numbers, like {'bidders': 30}.
+    """
+    def __init__(self, name, seconds, queries, values):
+        self.name = name
+        self.seconds = seconds
+        self.queries = queries
+        self.values = values
+
+
+def register(callback):
+    """
+    Call `callback` with an `Event` after every instrumented operation
+    """
+    if callback not in _callbacks:
+        _callbacks.append(callback)
+
+
+def unregister(callback):
+    if callback in _callbacks:
+        _callbacks.remove(callback)
+
+
+@contextmanager
+def instrument(name, **values):
+    """
+    Measure the code in the with block as the operation `name`
+
+    Yields a dict of values for the event, which the block may add to.
+    """
+    if not _callbacks:
+        yield values
+        return
+    with _count_queries() as queries:
+        start = time.time()
+        yield values
+        seconds = time.time() - start
+    event = Event(name, seconds, queries[0], values)
+    for callback in list(_callbacks):
+        try:
+            callback(event)
+        except Exception:
+            logger.exception("Instrumentation callback failed")
+
+
+@contextmanager
+def _count_queries():
+    """
+    Count the queries made on every database connection of this thread
+
+    Yields a one item list holding the count.  Unlike Django's
+    CaptureQueriesContext this doesn't turn on debug cursors, so the
+    queries aren't logged.
+    """
+    count = [0]
+
+    def execute_wrapper(execute, sql, params, many, context):
+        count[0] += 1
+        return execute(sql, params, many, context)
+
+    patched = []
+    try:
+        for conn in connections.all():
+            if hasattr(conn, 'execute_wrappers'):
+                conn.execute_wrappers.append(execute_wrapper)
+            else:
+                _patch_cursor(conn, count)
+            patched.append(conn)
+        yield count
+    finally:
+        for conn in reversed(patched):
+            if hasattr(conn, 'execute_wrappers'):
+                conn.execute_wrappers.remove(execute_wrapper)
+            else:
+                _unpatch_cursor(conn)
+
+
+def _patch_cursor(conn, count):
+    # Django before 2.0 has no execute wrappers, so the connection's
+    # cursors are wrapped instead.
+    cursor = conn.cursor
+    conn.__dict__.setdefault('_instrument_cursors', []).append(
+        conn.__dict__.get('cursor'))
+    conn.cursor = lambda: _CountingCursor(cursor(), count)
+
+
+def _unpatch_cursor(conn):
+    previous = conn.__dict__['_instrument_cursors'].pop()
+    if previous is None:
+        del conn.cursor
+    else:
+        conn.cursor = previous
+
+
+class _CountingCursor(object):
+    def __init__(self, cursor, count):
+        self.cursor = cursor
+        self.count = count
+
+    def execute(self, *args, **kwargs):
+        self.count[0] += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.count[0] += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.cursor.__exit__(*exc_info)
+
+
+class Aggregator(object):
+    """
+    Keeps running totals of events in this process
+
+    Values named in `gauges` keep their last value, other values are
+    summed.
+    """
+    gauges = ('fill_rate',)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, event):
+        with self._lock:
+            totals = self.totals[event.name]
+            totals['count'] += 1
+            totals['seconds'] += event.seconds
+            totals['queries'] += event.queries
+            for key, value in event.values.items():
+                if key in self.gauges:
+                    self.last[event.name][key] = value
+                else:
+                    totals[key] += value
+
+    def reset(self):
+        with self._lock:
+            self.totals = collections.defaultdict(
+                lambda: collections.defaultdict(float))
+            self.last = collections.defaultdict(dict)
+
+    def prometheus(self):
+        """
+        The totals in the Prometheus text exposition format
+        """
+        with self._lock:
+            summary = []
+            samples = collections.defaultdict(list)
+            for name in sorted(self.totals):
+                totals = self.totals[name]
+                summary.append((name, totals['seconds'], totals['count']))
+                for key, value in totals.items():
+                    if key not in ('seconds', 'count'):
+                        samples[key + '_total'].append((name, value))
+                for key, value in self.last[name].items():
+                    samples[key].append((name, value))
+        lines = ['# TYPE timeslot_lottery_operation_seconds summary']
+        for name, seconds, count in summary:
+            lines.append(_sample('operation_seconds_sum', name, seconds))
+            lines.append(_sample('operation_seconds_count', name, count))
+        for metric in sorted(samples):
+            kind = 'counter' if metric.endswith('_total') else 'gauge'
+            lines.append('# TYPE timeslot_lottery_{} {}'.format(metric, kind))
+            for name, value in sorted(samples[metric]):
+                lines.append(_sample(metric, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Write the Prometheus text to a file, replacing it atomically
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.prometheus())
+        os.rename(tmp_path, path)
+
+
+def _sample(metric, operation, value):
+    return 'timeslot_lottery_{}{{operation="{}"}} {!r}'.format(
+        metric, operation, float(value))
+
+
+aggregator = Aggregator()
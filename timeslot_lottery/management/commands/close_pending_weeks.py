@@ -1,23 +1,52 @@
 # -*- coding: utf-8 -*-
-import sys
+from optparse import make_option
 
 from django.core.management.base import BaseCommand
 
+from timeslot_lottery import instrumentation
+from timeslot_lottery.instrumentation import instrument
 from timeslot_lottery.models import Week
 
 
 class Command(BaseCommand):
     help = "Close and calculate winners for pending weeks"
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=1,
+                    help="Number of weeks to close at the same time"),
+        make_option('--batch-size', type='int', default=100,
+                    dest='batch_size',
+                    help="Number of pending weeks to fetch at a time"),
+        make_option('--metrics-file', dest='metrics_file',
+                    help="Write Prometheus metrics of the run to this file"),
+    )
+
     def handle(self, *args, **options):
-        results = Week.objects.close_pending()
-
-        if results:
-            sys.stdout.write("{:10s} {:6s} {:6s}"
-                             .format("week", "wins", "left_bids"))
-        for week, close_result in results.items():
-            msg = u"{:10s}: {:6d} {:6d}".format(
-                week,
-                len(close_result['updated_slots']),
-                len(close_result['remaining_bidders']))
-            sys.stdout.write(msg.encode('utf-8'))
+        metrics_file = options.get('metrics_file')
+        if metrics_file:
+            instrumentation.register(instrumentation.aggregator)
+        try:
+            self._close_pending(options)
+        finally:
+            if metrics_file:
+                instrumentation.aggregator.write_prometheus(metrics_file)
+
+    def _close_pending(self, options):
+        results = Week.objects.iter_close_pending(
+            workers=options['workers'], batch_size=options['batch_size'])
+
+        with instrument('close_pending') as values:
+            values['weeks'] = 0
+            for week, close_result, seconds in results:
+                if not values['weeks']:
+                    self.stdout.write(
+                        u"{:20s} {:10s} {:>6s} {:>9s} {:>8s}".format(
+                            "template", "week", "wins", "left_bids",
+                            "seconds"))
+                values['weeks'] += 1
+                self.stdout.write(u"{:20s} {:10s} {:6d} {:9d} {:8.3f}".format(
+                    week.template.slug,
+                    u"{}-{:02d}".format(week.year, week.week_no),
+                    len(close_result['updated_slots']),
+                    len(close_result['remaining_bidders']),
+                    seconds))
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from timeslot_lottery.models import BID_STORAGES
+from timeslot_lottery.models import Week
+from timeslot_lottery.models import convert_bids
+
+
+class Command(BaseCommand):
+    help = ("Move bids between the Slot.bidders table and bit masks, "
+            "see TIMESLOT_LOTTERY_BID_STORAGE")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--to', choices=sorted(BID_STORAGES),
+                    default='bitmask',
+                    help="Storage to move the bids to, m2m or bitmask"),
+        make_option('--template', dest='template_slug',
+                    help="Only convert the weeks of this template"),
+    )
+
+    def handle(self, *args, **options):
+        weeks = Week.objects.all()
+        if options['template_slug']:
+            weeks = weeks.filter(template__slug=options['template_slug'])
+        moved = convert_bids(options['to'], weeks)
+        self.stdout.write("Moved {} bids to {}".format(moved, options['to']))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from timeslot_lottery import export
+from timeslot_lottery.models import Template
+
+
+class Command(BaseCommand):
+    args = "<template slug>"
+    help = "Write the weeks, slots, winners and bidders of a template"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=export.FORMATS, default='csv',
+                    help="csv or jsonl (JSON Lines)"),
+        make_option('--chunk-size', type='int', default=500,
+                    dest='chunk_size',
+                    help="Number of slots to read at a time"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the slug of one template")
+        try:
+            template = Template.objects.get(slug=args[0])
+        except Template.DoesNotExist:
+            raise CommandError("No template {!r}".format(args[0]))
+        for line in export.export(template, options['format'],
+                                  options['chunk_size']):
+            self.stdout.write(line, ending='')
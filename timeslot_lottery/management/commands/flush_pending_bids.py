@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from timeslot_lottery.models import PendingBid
+
+
+class Command(BaseCommand):
+    help = "Write buffered bids to the slots"
+
+    def handle(self, *args, **options):
+        count = PendingBid.objects.flush()
+        self.stdout.write("Flushed pending bids of {} users".format(count))
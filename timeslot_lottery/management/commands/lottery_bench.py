@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from timeslot_lottery.bench import run_benchmarks
+from timeslot_lottery.bench.data import DISTRIBUTIONS
+from timeslot_lottery.bench.runner import BENCHMARKS
+
+
+class Command(BaseCommand):
+    args = "[benchmark ...]"
+    help = ("Time the lottery's hot paths on synthetic data and print "
+            "the results as JSON.  Benchmarks: " + ", ".join(BENCHMARKS))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--slots', type='int', default=100,
+                    help="Slots per week"),
+        make_option('--users', type='int', default=1000,
+                    help="Number of bidders"),
+        make_option('--bids-per-user', type='int', default=5,
+                    dest='bids_per_user',
+                    help="Slots every bidder bids for"),
+        make_option('--distribution', choices=DISTRIBUTIONS,
+                    default='uniform',
+                    help="How bids are spread over the slots"),
+        make_option('--max-wins', type='int', default=10, dest='max_wins',
+                    help="Highest number of earlier wins per user"),
+        make_option('--weeks', type='int', default=10,
+                    help="Pending weeks for close_pending"),
+        make_option('--seed', type='int', default=0,
+                    help="Seed for the synthetic data"),
+        make_option('--output', help="Write the JSON to this file"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            results = run_benchmarks(
+                args or BENCHMARKS,
+                slots=options['slots'],
+                users=options['users'],
+                bids_per_user=options['bids_per_user'],
+                distribution=options['distribution'],
+                max_wins=options['max_wins'],
+                weeks=options['weeks'],
+                seed=options['seed'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        report = json.dumps({
+            'parameters': dict((key, options[key]) for key in (
+                'slots', 'users', 'bids_per_user', 'distribution',
+                'max_wins', 'weeks', 'seed')),
+            'results': results,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from timeslot_lottery.models import Template
+
+
+class Command(BaseCommand):
+    help = "Create the current week of every template that has opened"
+
+    def handle(self, *args, **options):
+        weeks = Template.objects.open_due_weeks()
+
+        for week in weeks:
+            self.stdout.write(u"{:20s} {}-{:02d}".format(
+                week.template.slug, week.year, week.week_no))
+        self.stdout.write("Opened {} weeks".format(len(weeks)))
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from timeslot_lottery.models import WinCount
+
+
+class Command(BaseCommand):
+    help = "Recount the per-template wins of every user from slot winners"
+
+    def handle(self, *args, **options):
+        count = WinCount.objects.rebuild()
+        self.stdout.write("Rebuilt {} win counters".format(count))
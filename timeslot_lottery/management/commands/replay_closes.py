@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from timeslot_lottery.models import CloseResult
+
+
+class Command(BaseCommand):
+    help = ("Run the lottery again from the stored snapshots of closed "
+            "weeks and check that it gives the stored winners")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--template', dest='template',
+                    help="Only weeks of the template with this slug"),
+        make_option('--year', type='int', dest='year',
+                    help="Only weeks in this year"),
+    )
+
+    def handle(self, *args, **options):
+        results = CloseResult.objects.select_related('week__template')
+        if options['template']:
+            results = results.filter(week__template__slug=options['template'])
+        if options['year']:
+            results = results.filter(week__year=options['year'])
+
+        verified = skipped = 0
+        mismatches = []
+        for result in results.iterator():
+            if not result.snapshot:
+                skipped += 1
+            elif result.verify():
+                verified += 1
+            else:
+                mismatches.append(result.week)
+                self.stdout.write(u"Mismatch: {} {}-{:02d}".format(
+                    result.week.template.slug,
+                    result.week.year, result.week.week_no))
+
+        self.stdout.write("{} verified, {} without snapshot, {} mismatched"
+                          .format(verified, skipped, len(mismatches)))
+        if mismatches:
+            raise CommandError("Replay doesn't match stored results")
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import json
+from optparse import make_option
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from timeslot_lottery import allocation
+from timeslot_lottery import simulation
+from timeslot_lottery.models import CloseResult
+from timeslot_lottery.models import Week
+from timeslot_lottery.schedule import compile_schedule
+
+
+class Command(BaseCommand):
+    args = "<template slug> <year>-<week>"
+    help = ("Allocate a week's bids many times without saving anything, "
+            "and print the fill rate and win probabilities as JSON")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--runs', type='int', default=1000,
+                    help="Number of allocations to simulate"),
+        make_option('--workers', type='int', default=1,
+                    help="Number of processes to simulate in"),
+        make_option('--seed', type='int', default=0,
+                    help="Seed for the seeds of the runs"),
+        make_option('--strategy', choices=sorted(allocation.STRATEGIES),
+                    help="Allocation strategy, defaults to the week's own"),
+        make_option('--slots', type='int',
+                    help="Simulate the week with this many slots"),
+        make_option('--template-slots', dest='template_slots',
+                    help="Simulate the week with these template slots, "
+                         "as JSON like {\"1\": [\"10:00\"]}"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or '-' not in args[1]:
+            raise CommandError("Give a template slug and a week like "
+                               "2014-03")
+        year, week_no = args[1].split('-', 1)
+        try:
+            week = Week.objects.get(template__slug=args[0], year=year,
+                                    week_no=week_no)
+        except (Week.DoesNotExist, ValueError):
+            raise CommandError("No week {} {}".format(*args))
+
+        snapshot = self.snapshot(week)
+        if options['strategy']:
+            snapshot.strategy = options['strategy']
+        if options['template_slots']:
+            try:
+                schedule = compile_schedule(
+                    json.loads(options['template_slots']))
+            except (ValueError, ValidationError) as e:
+                raise CommandError("Bad template slots: {}".format(e))
+            snapshot = simulation.rescale(snapshot, len(schedule))
+            snapshot.capacities = dict(zip(snapshot.slot_ids,
+                                           schedule.capacities))
+        elif options['slots'] is not None:
+            snapshot = simulation.rescale(snapshot, options['slots'])
+
+        result = simulation.simulate(snapshot, runs=options['runs'],
+                                     seed=options['seed'],
+                                     workers=options['workers'])
+        summary = result.summary()
+        summary['strategy'] = snapshot.strategy
+        self.stdout.write(json.dumps(summary, indent=2, sort_keys=True))
+
+    def snapshot(self, week):
+        """
+        The snapshot a closed week was allocated from, or the current one
+
+        Pending bids of an open week are read, not flushed.
+        """
+        try:
+            stored = week.close_result.snapshot
+        except CloseResult.DoesNotExist:
+            stored = None
+        if stored:
+            return allocation.Snapshot.from_json(stored)
+        return week.snapshot(flush=False)
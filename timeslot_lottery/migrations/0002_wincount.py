@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+def count_wins(apps, schema_editor):
+    Slot = apps.get_model('timeslot_lottery', 'Slot')
+    WinCount = apps.get_model('timeslot_lottery', 'WinCount')
+    WinCount.objects.bulk_create([
+        WinCount(template_id=template_id, user_id=user_id, count=count)
+        for user_id, template_id, count
+        in (Slot.objects.filter(winner__isnull=False)
+            .values_list('winner', 'week__template')
+            .annotate(models.Count('pk'))
+            .order_by())])
+
+
+def delete_win_counts(apps, schema_editor):
+    apps.get_model('timeslot_lottery', 'WinCount').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timeslot_lottery', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WinCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('template', models.ForeignKey(related_name='win_counts', to='timeslot_lottery.Template')),
+                ('user', models.ForeignKey(related_name='win_counts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='wincount',
+            unique_together=set([('user', 'template')]),
+        ),
+        migrations.RunPython(count_wins, delete_win_counts),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import model_utils.fields
+import jsonfield.fields
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeslot_lottery', '0002_wincount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloseResult',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('strategy', models.CharField(max_length=32)),
+                ('allocation', jsonfield.fields.JSONField(default=[])),
+                ('remaining_bidders', jsonfield.fields.JSONField(default=[])),
+                ('duration', models.FloatField()),
+                ('week', models.OneToOneField(related_name='close_result', to='timeslot_lottery.Week')),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+
+from django.db import models, migrations
+import jsonfield.fields
+import timeslot_lottery.models
+
+
+def reseed_weeks(apps, schema_editor):
+    # The field default only gave all existing weeks the same seed
+    Week = apps.get_model('timeslot_lottery', 'Week')
+    rng = random.SystemRandom()
+    for week_id in Week.objects.values_list('pk', flat=True):
+        (Week.objects.filter(pk=week_id)
+         .update(seed=rng.randint(0, 2 ** 31 - 1)))
+
+
+def keep_seeds(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeslot_lottery', '0003_closeresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='week',
+            name='seed',
+            field=models.PositiveIntegerField(default=timeslot_lottery.models.new_seed, help_text=b'Seed for the random order of equally deserving bidders.'),
+            preserve_default=True,
+        ),
+        migrations.RunPython(reseed_weeks, keep_seeds),
+        migrations.AddField(
+            model_name='closeresult',
+            name='seed',
+            field=models.PositiveIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='closeresult',
+            name='snapshot',
+            field=jsonfield.fields.JSONField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
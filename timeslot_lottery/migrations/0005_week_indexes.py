@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeslot_lottery', '0004_seeds_and_snapshots'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='week',
+            index_together=set([('status', 'auto_close_from'), ('template', 'year', 'week_no')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import model_utils.fields
+import jsonfield.fields
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timeslot_lottery', '0005_week_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingBid',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('slot_ids', jsonfield.fields.JSONField(default=[])),
+                ('user', models.ForeignKey(related_name='pending_bids', to=settings.AUTH_USER_MODEL)),
+                ('week', models.ForeignKey(related_name='pending_bids', to='timeslot_lottery.Week')),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pendingbid',
+            unique_together=set([('week', 'user')]),
+        ),
+    ]
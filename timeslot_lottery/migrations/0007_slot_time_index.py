@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeslot_lottery', '0006_pendingbid'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='slot',
+            name='time',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
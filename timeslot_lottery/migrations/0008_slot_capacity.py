@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import jsonfield.fields
+
+
+def copy_winners(apps, schema_editor):
+    Slot = apps.get_model('timeslot_lottery', 'Slot')
+    Winners = Slot.winners.through
+    Winners.objects.bulk_create([
+        Winners(slot_id=slot_id, user_id=user_id)
+        for slot_id, user_id
+        in Slot.objects.filter(winner__isnull=False)
+        .values_list('pk', 'winner')], batch_size=500)
+
+
+def keep_winners(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timeslot_lottery', '0007_slot_time_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slot',
+            name='capacity',
+            field=models.PositiveSmallIntegerField(default=1),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='slot',
+            name='winners',
+            field=models.ManyToManyField(related_name='seats_won', to=settings.AUTH_USER_MODEL, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='template',
+            name='slots',
+            field=jsonfield.fields.JSONField(default={1: [], 2: [], 3: [], 4: [], 5: [], 6: [], 7: []}, help_text='1=Monday, 7=Sunday. For two slots thursday, you could write: {4: ["09:00", "17:30"]}. For room for 3 winners at 17:30, write ["17:30", 3].'),
+        ),
+        migrations.RunPython(copy_winners, keep_winners),
+    ]
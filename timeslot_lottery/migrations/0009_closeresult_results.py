@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeslot_lottery', '0008_slot_capacity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='closeresult',
+            name='results',
+            field=jsonfield.fields.JSONField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import model_utils.fields
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timeslot_lottery', '0009_closeresult_results'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BidMask',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('mask', models.TextField()),
+                ('order_hash', models.CharField(max_length=16)),
+                ('user', models.ForeignKey(related_name='bid_masks', to=settings.AUTH_USER_MODEL)),
+                ('week', models.ForeignKey(related_name='bid_masks', to='timeslot_lottery.Week')),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='bidmask',
+            unique_together=set([('week', 'user')]),
+        ),
+    ]
@@ -1,23 +1,201 @@
-import collections
+from collections import OrderedDict
+from collections import defaultdict
+import copy
 import datetime
+import hashlib
 import logging
 import random
+import time
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.db import OperationalError
+from django.db import connection
 from django.db import models
 from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import six
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
 
 from jsonfield import JSONField
 from model_utils import Choices
 from model_utils.models import TimeStampedModel
 
+from timeslot_lottery import allocation
+from timeslot_lottery import caching
+from timeslot_lottery import routers
+from timeslot_lottery.instrumentation import instrument
+from timeslot_lottery.schedule import compile_schedule
 from timeslot_lottery.utils import iso_to_gregorian
+from timeslot_lottery.utils import iso_weeks_to_gregorian
 
 
 logger = logging.getLogger(__name__)
 
+# Rows per insert and ids per IN clause when flushing pending bids
+FLUSH_BATCH_SIZE = 500
+
+# Tries to close a week before giving up, and seconds to wait between
+CLOSE_ATTEMPTS = 3
+CLOSE_RETRY_DELAY = 0.5
+
+# Cache name of everything listing weeks across templates
+WEEKS_CACHE_NAME = 'weeks'
+
+# Seconds to keep cached data; caches that aren't shared between
+# processes, like the default LocMemCache, can be stale for this long
+CACHE_TIMEOUT = getattr(settings, 'TIMESLOT_LOTTERY_CACHE_TIMEOUT', 600)
+
+
+def user_cache_name(user):
+    "Cache name of data about one user's bids and wins"
+    return 'user-{}'.format(user.pk)
+
+
+def bid_storage():
+    """
+    The storage bids are read from and written to
+
+    Set TIMESLOT_LOTTERY_BID_STORAGE to 'bitmask' to store one `BidMask`
+    row per user and week instead of a Slot.bidders row per bid.  The
+    convert_bids command moves existing bids between the two.
+    """
+    return BID_STORAGES[
+        getattr(settings, 'TIMESLOT_LOTTERY_BID_STORAGE', 'm2m')]
+
+
+class TemplateManager(models.Manager):
+    @routers.primary()
+    def create_weeks(self, year_week_tuples, templates=None):
+        """
+        Create weeks with slots for many templates in a few queries
+
+        Weeks that already exist are left alone.  Apart from the
+        batching bulk_create does on some databases, the number of
+        queries doesn't depend on the number of weeks or slots.  The
+        templates are looked up in chunks of FLUSH_BATCH_SIZE, to keep
+        the IN clauses under the database's parameter limit.
+
+        Arguments:
+          year_week_tuples  The (year, week number) tuples to create.
+          templates         Templates to create weeks for.  Defaults to
+                            all templates.
+
+        Returns:
+          A list of the created weeks.
+        """
+        if templates is None:
+            templates = self.all()
+        templates = list(templates)
+        year_weeks = set(tuple(map(int, year_week))
+                         for year_week in year_week_tuples)
+        if not templates or not year_weeks:
+            return []
+        weeks_query = Week.objects.filter(
+            year__in=set(year for year, _ in year_weeks),
+            week_no__in=set(week_no for _, week_no in year_weeks))
+
+        def week_keys(*fields):
+            for chunk in _chunks(templates):
+                for key in (weeks_query.filter(template__in=chunk)
+                            .values_list(*fields)):
+                    yield key
+
+        with instrument('week_creation') as values, transaction.atomic():
+            existing = set(week_keys('template', 'year', 'week_no'))
+            new_weeks = [template._new_week(year_week)
+                         for template in templates
+                         for year_week in sorted(year_weeks)
+                         if (template.pk,) + year_week not in existing]
+            if not new_weeks:
+                return []
+            Week.objects.bulk_create(new_weeks)
+            # bulk_create doesn't give us primary keys, so look them up
+            week_ids = dict(
+                ((template_id, year, week_no), pk)
+                for pk, template_id, year, week_no
+                in week_keys('pk', 'template', 'year', 'week_no'))
+            new_slots = []
+            for week in new_weeks:
+                week.pk = week_ids[week.template_id, week.year, week.week_no]
+                new_slots.extend(week.template._new_slots(week))
+            Slot.objects.bulk_create(new_slots)
+            values.update(weeks=len(new_weeks), slots=len(new_slots))
+        caching.bump(WEEKS_CACHE_NAME,
+                     *(set(week.template.cache_name for week in new_weeks) |
+                       set(week.cache_name for week in new_weeks)))
+        cache.set_many(dict((_pending_key(week.pk), False)
+                            for week in new_weeks), CACHE_TIMEOUT)
+        return new_weeks
+
+    def concrete_times(self, template_year_weeks):
+        """
+        Opening and closing datetimes of many weeks in one go
+
+        Arguments:
+          template_year_weeks  Iterable of (template, year, week number)
+                               tuples.
+
+        Returns:
+          A list of (opening, closing) tuples in the same order.  Times
+          missing from a template are None.
+        """
+        template_year_weeks = list(template_year_weeks)
+        week_starts = iso_weeks_to_gregorian(
+            (year, week_no) for _, year, week_no in template_year_weeks)
+        return [(template.schedule.opening_time(week_start),
+                 template.schedule.closing_time(week_start))
+                for (template, _, _), week_start
+                in zip(template_year_weeks, week_starts)]
+
+    def due_for_opening(self, now=None):
+        """
+        Templates whose week for `now` is open but not yet created
+
+        Templates without an auto opening time are never due.  Needs
+        one query, however many templates there are.
+        """
+        now = now or timezone.now()
+        year, week_no = now.isocalendar()[:2]
+        templates = list(
+            self.filter(auto_opening__isnull=False)
+            .exclude(pk__in=Week.objects.filter(year=year, week_no=week_no)
+                     .values('template')))
+        opening_times = self.concrete_times(
+            (template, year, week_no) for template in templates)
+        return [template for template, (opening, _)
+                in zip(templates, opening_times)
+                if opening <= now]
+
+    def open_due_weeks(self, now=None):
+        """
+        Create the weeks of all templates that are due for opening
+
+        Returns:
+          A list of the created weeks.
+        """
+        now = now or timezone.now()
+        return self.create_weeks([now.isocalendar()[:2]],
+                                 self.due_for_opening(now))
+
+    def create_upcoming_weeks(self, count, templates=None):
+        """
+        Create this week and the next `count - 1` weeks for templates
+        """
+        today = timezone.now().date()
+        return self.create_weeks(
+            [(today + datetime.timedelta(weeks=i)).isocalendar()[:2]
+             for i in range(count)],
+            templates)
+
 
 class Template(TimeStampedModel):
     """
@@ -27,8 +205,10 @@ class Template(TimeStampedModel):
       slug   The name of the template.
       slots  A dict with days 1 (monday) to 7 (sunday) as keys.
              Every day has a list of times as a string with hour
-             and minute separated by a colon.
-             E.g. {1: ['10:30', '16:00']}
+             and minute separated by a colon, or a pair of such a
+             time and the number of winners the slot has room for.
+             E.g. {1: ['10:30', ['16:00', 4]]}
+             It's compiled into `schedule`, and validated on save.
     """
     title = models.CharField(max_length=32)
     slug = models.SlugField()
@@ -36,7 +216,9 @@ class Template(TimeStampedModel):
     slots = JSONField(
         default={1: [], 2: [], 3: [], 4: [], 5: [], 6: [], 7: []},
         help_text="""1=Monday, 7=Sunday. For two slots thursday, """
-                  """you could write: {4: ["09:00", "17:30"]}""")
+                  """you could write: {4: ["09:00", "17:30"]}. """
+                  """For room for 3 winners at 17:30, write """
+                  """["17:30", 3].""")
     auto_opening = models.DateTimeField(
         blank=True, null=True,
         help_text="""Not used as a fixed date.  Only the day and time """
@@ -47,26 +229,72 @@ class Template(TimeStampedModel):
         help_text="""Not used as a fixed date.  Only the relative """
                   """time back to the auto opening time is considered.""")
 
+    objects = TemplateManager()
+
     def __unicode__(self):
         return "{}".format(self.title)
 
+    def clean(self):
+        try:
+            self.schedule
+        except ValidationError as e:
+            raise ValidationError({'slots': e.messages})
+
+    def save(self, *args, **kwargs):
+        # Compile the changed schedule, which also validates it
+        self.__dict__.pop('schedule', None)
+        self.schedule
+        super(Template, self).save(*args, **kwargs)
+
+    @cached_property
+    def schedule(self):
+        """
+        The compiled `schedule.Schedule` of the slots, opening and closing
+        """
+        return compile_schedule(self.slots, self.auto_opening,
+                                self.auto_closing)
+
     def concrete_opening_time(self, year, week):
-        isoday = self.auto_opening.isoweekday()
-        date = iso_to_gregorian(year, week, isoday)
-        return datetime.datetime.combine(date, self.auto_opening.time())
+        return self.schedule.opening_time(iso_to_gregorian(year, week, 1))
 
     def concrete_closing_time(self, year, week):
-        close_delta = self.auto_closing - self.auto_opening
-        return self.concrete_opening_time(year, week) + close_delta
+        return self.schedule.closing_time(iso_to_gregorian(year, week, 1))
 
     def current_week(self, year_week_tuple=None):
+        """
+        The week for now or the given ISO (year, week) tuple, or None
+
+        Looked up once per instance and week.
+        """
         if not year_week_tuple:
             year_week_tuple = timezone.now().isocalendar()[:2]
-        year, week_no = year_week_tuple
-        try:
-            return self.weeks.get(year=year, week_no=week_no)
-        except Week.DoesNotExist:
-            return None
+        year, week_no = map(int, year_week_tuple)
+        if (year, week_no) not in self._weeks_by_number:
+            try:
+                week = self.weeks.get(year=year, week_no=week_no)
+            except Week.DoesNotExist:
+                week = None
+            self._weeks_by_number[year, week_no] = week
+        return self._weeks_by_number[year, week_no]
+
+    @cached_property
+    def _weeks_by_number(self):
+        return {}
+
+    def weeks_before(self, year_week_tuple=None, count=20):
+        """
+        The latest weeks before the given (year, week) tuple, newest first
+
+        Uses keyset pagination on (year, week_no), so the cost doesn't
+        depend on how many weeks come after.  Without a tuple the latest
+        weeks are returned.
+        """
+        weeks = self.weeks.order_by('-year', '-week_no')
+        if year_week_tuple:
+            year, week_no = map(int, year_week_tuple)
+            weeks = weeks.filter(models.Q(year__lt=year) |
+                                 models.Q(year=year, week_no__lt=week_no))
+        return list(weeks[:count])
 
     def create_current_week(self):
         """
@@ -84,25 +312,110 @@ class Template(TimeStampedModel):
         self.create_new_week((year, week))
         return True
 
+    @property
+    def cache_name(self):
+        """
+        Name of cached data that changes with the template's weeks
+        """
+        return 'template-{}'.format(self.pk)
+
+    @routers.primary()
     def create_new_week(self, year_week_tuple=None):
+        with instrument('week_creation') as values, transaction.atomic():
+            week = self._new_week(year_week_tuple)
+            week.save()
+            slots = self._new_slots(week)
+            Slot.objects.bulk_create(slots)
+            values.update(weeks=1, slots=len(slots))
+        self._weeks_by_number[week.year, week.week_no] = week
+        caching.bump(self.cache_name, week.cache_name, WEEKS_CACHE_NAME)
+        cache.set(_pending_key(week.pk), False, CACHE_TIMEOUT)
+        return week
+
+    def _new_week(self, year_week_tuple=None):
+        """
+        Unsaved week for the given year and week number
+        """
         if not year_week_tuple:
             year_week_tuple = timezone.now().isocalendar()[:2]
-        year, week_no = year_week_tuple
-        week_start = iso_to_gregorian(year, week_no, 1)
-        week = Week.objects.create(year=year, week_no=week_no, template=self)
+        year, week_no = map(int, year_week_tuple)
+        week = Week(year=year, week_no=week_no, template=self)
         if self.auto_opening and self.auto_closing:
-            week.auto_close_from = self.concrete_closing_time(year, week)
-        for day, times in self.slots.items():
-            for time in times:
-                hour, minute = map(int, time.split(':'))
-                slot_date = week_start.replace(day=week_start.day + (day-1))
-                slot_time = datetime.time(hour, minute)
-                slot_datetime = datetime.datetime.combine(slot_date, slot_time)
-                Slot.objects.create(week=week, time=slot_datetime)
+            week.auto_close_from = self.concrete_closing_time(year, week_no)
         return week
 
+    def _new_slots(self, week):
+        """
+        Unsaved slots for a saved week of this template
+        """
+        week_start = iso_to_gregorian(week.year, week.week_no, 1)
+        return [Slot(week=week, time=time, capacity=capacity)
+                for time, capacity in zip(self.schedule.datetimes(week_start),
+                                          self.schedule.capacities)]
+
+
+def new_seed():
+    return random.SystemRandom().randint(0, 2 ** 31 - 1)
+
 
 class WeekManager(models.Manager):
+    def pending(self):
+        """
+        Weeks that are past their closing time but not closed
+        """
+        return self.filter(
+            status__in=[Week.STATUS.new, Week.STATUS.active],
+            auto_close_from__lte=timezone.now())
+
+    def upcoming(self, year_week_tuple):
+        """
+        Weeks of all templates from the given (year, week) onwards
+        """
+        year, week_no = year_week_tuple
+        return (self.filter(models.Q(year__gt=year) |
+                            models.Q(year=year, week_no__gte=week_no))
+                .order_by('year', 'week_no', 'template'))
+
+    def for_user(self, user, year_week_tuple):
+        """
+        Upcoming weeks with the user's bids and wins
+
+        Uses five queries however many weeks and templates there are.
+        Every week gets `user_bids` and `user_wins`, sorted lists of slot
+        times, and `has_pending_bids`.
+        """
+        weeks = list(self.upcoming(year_week_tuple).select_related('template'))
+        for week in weeks:
+            week.user_bids = []
+            week.user_wins = []
+            week.has_pending_bids = False
+        if not weeks or user.pk is None:
+            return weeks
+        weeks_by_id = dict((week.pk, week) for week in weeks)
+        bids = bid_storage().user_bids(list(weeks_by_id), user.pk)
+        # Pending bids replace the stored bids of their week
+        for pending in PendingBid.objects.filter(week__in=list(weeks_by_id),
+                                                 user=user):
+            weeks_by_id[pending.week_id].has_pending_bids = True
+            bids = dict((slot_id, week_id) for slot_id, week_id
+                        in bids.items() if week_id != pending.week_id)
+            bids.update((slot_id, pending.week_id)
+                        for slot_id in pending.slot_ids)
+        winners, slot_field, user_field = winner_relation()
+        wins = set(winners.objects
+                   .filter(**{slot_field + '__week__in': list(weeks_by_id),
+                              user_field: user})
+                   .values_list(slot_field, flat=True))
+        slots = (Slot.objects.filter(pk__in=list(set(bids) | wins))
+                 .values_list('pk', 'week', 'time'))
+        for slot_id, week_id, slot_time in slots:
+            week = weeks_by_id[week_id]
+            if slot_id in bids:
+                week.user_bids.append(slot_time)
+            if slot_id in wins:
+                week.user_wins.append(slot_time)
+        return weeks
+
     def close_pending(self):
         """
         Close and calculate winners for pending weeks
@@ -111,17 +424,151 @@ class WeekManager(models.Manager):
           A dict mapping between the week-object and a
           dict with the results of the week close.
         """
-        now = timezone.now()
-        to_close = (self.filter(auto_close_from__lte=now)
-                    .exclude(status=Week.STATUS.closed))
-        week_to_close_result = {}
-        for week in to_close:
+        with instrument('close_pending') as values:
+            results = dict((week, close_result) for week, close_result, _
+                           in self.iter_close_pending())
+            values['weeks'] = len(results)
+        return results
+
+    def iter_close_pending(self, workers=1, batch_size=100):
+        """
+        Close pending weeks, yielding the results as they finish
+
+        Pending weeks are fetched `batch_size` at a time in closing time
+        order.  The weeks of one template are closed one after the other,
+        so each close counts the wins of the ones before; `workers`
+        threads close the weeks of different templates at the same time.
+        Every week is closed in its own transaction while holding a row
+        lock on it, so several processes can work through the same
+        pending weeks.  Weeks closed by someone else are skipped; if
+        someone else is closing a week, the later weeks of its template
+        are left for the next run.
+
+        Yields:
+          (week, close result dict, seconds used) tuples.
+        """
+        pool = ThreadPool(workers) if workers > 1 else None
+        pending = self.pending().order_by('auto_close_from', 'pk')
+        blocked = set()
+        last = None
+        try:
+            while True:
+                batch = pending
+                if last is not None:
+                    close_from, pk = last
+                    batch = batch.filter(
+                        models.Q(auto_close_from__gt=close_from) |
+                        models.Q(auto_close_from=close_from, pk__gt=pk))
+                batch = list(batch.values_list(
+                    'pk', 'template', 'auto_close_from')[:batch_size])
+                if not batch:
+                    break
+                last = batch[-1][2], batch[-1][0]
+                week_ids = OrderedDict()
+                for week_id, template_id, _ in batch:
+                    if template_id not in blocked:
+                        week_ids.setdefault(template_id, []).append(week_id)
+                if pool:
+                    groups = pool.imap_unordered(
+                        self._close_in_thread, week_ids.items())
+                else:
+                    groups = (self._close_template(item)
+                              for item in week_ids.items())
+                for template_id, results in groups:
+                    for result in results:
+                        if result is False:
+                            blocked.add(template_id)
+                        elif result:
+                            yield result
+        finally:
+            if pool:
+                pool.terminate()
+
+    def iter_close(self, week_ids):
+        """
+        Close the weeks with the given ids one by one
+
+        Weeks locked or closed by someone else are skipped, like in
+        `iter_close_pending`.
+
+        Yields:
+          (week, close result dict, seconds used) tuples.
+        """
+        for week_id in week_ids:
+            result = self._close(week_id)
+            if result:
+                yield result
+
+    def _close_template(self, template_week_ids):
+        """
+        Close weeks of one template in order, up to one that's locked
+
+        Returns:
+          The template id and a list of `_close` results.
+        """
+        template_id, week_ids = template_week_ids
+        results = []
+        for week_id in week_ids:
+            result = self._close(week_id)
+            results.append(result)
+            if result is False:
+                break
+        return template_id, results
+
+    def _close_in_thread(self, template_week_ids):
+        try:
+            return self._close_template(template_week_ids)
+        finally:
+            # Every thread has its own connection
+            connection.close()
+
+    @routers.primary()
+    def _close(self, week_id):
+        """
+        Close a week unless it's locked or already closed
+
+        Errors other than the row lock being taken, such as SQLite's
+        "database is locked", are retried CLOSE_ATTEMPTS times.
+
+        Returns:
+          A (week, close result dict, seconds used) tuple, None if the
+          week was closed already, or False if someone else holds its
+          lock.
+        """
+        for attempt in range(1, CLOSE_ATTEMPTS + 1):
+            try:
+                return self._close_once(week_id)
+            except OperationalError as e:
+                if attempt == CLOSE_ATTEMPTS:
+                    raise
+                logger.warning("Closing week {} failed, retrying: {}"
+                               .format(week_id, e))
+                # Jittered, so threads that collided don't collide again
+                time.sleep(CLOSE_RETRY_DELAY * attempt *
+                           random.uniform(0.5, 1.5))
+
+    def _close_once(self, week_id):
+        start = time.time()
+        nowait = connection.features.has_select_for_update_nowait
+        with instrument('week_close'), transaction.atomic():
+            try:
+                # In a savepoint, so the transaction stays usable
+                with transaction.atomic():
+                    week = (self.select_for_update(nowait=nowait)
+                            .get(pk=week_id))
+            except OperationalError:
+                if not nowait:
+                    raise
+                logger.info("Week {} is locked, skipping it."
+                            .format(week_id))
+                return False
+            if week.status == Week.STATUS.closed:
+                return None
             updated_slots, remaining_bidders = week.close()
-            week_to_close_result[week] = {
-                'updated_slots': updated_slots,
-                'remaining_bidders': remaining_bidders,
-            }
-        return week_to_close_result
+        return week, {
+            'updated_slots': updated_slots,
+            'remaining_bidders': remaining_bidders,
+        }, time.time() - start
 
 
 class Week(TimeStampedModel):
@@ -134,76 +581,298 @@ class Week(TimeStampedModel):
                               default=STATUS.new)
 
     auto_close_from = models.DateTimeField(blank=True, null=True)
+    seed = models.PositiveIntegerField(
+        default=new_seed,
+        help_text="""Seed for the random order of equally """
+                  """deserving bidders.""")
 
     objects = WeekManager()
 
     class Meta:
         unique_together = ('year', 'week_no', 'template')
+        index_together = [
+            ('status', 'auto_close_from'),
+            ('template', 'year', 'week_no'),
+        ]
 
     def __unicode__(self):
         return "{}-{}".format(self.year, self.week_no)
 
-    def fill_slots(self):
-        open_slots = (self.slots
-                      .annotate(num_bids=models.Count('bidders'))
-                      .filter(winner__isnull=True)
-                      .order_by('num_bids'))
-        bidders = (get_user_model().objects
-                   .annotate(num_wins=models.Count('slots_won'))
-                   .filter(slots_bid_for__week=self))
-        ordered_bidders = self._bidders_in_pick_order(bidders)
-        remaining_slots = list(open_slots)
+    @property
+    def cache_name(self):
+        return 'week-{}'.format(self.pk)
+
+    def slot_id_set(self):
+        """
+        Frozenset of the ids of the slots in this week, from the cache
+        """
+        key = caching.make_key(self.cache_name, 'slot-ids')
+        slot_ids = cache.get(key)
+        if slot_ids is None:
+            slot_ids = frozenset(self.slots.values_list('pk', flat=True))
+            cache.set(key, slot_ids, CACHE_TIMEOUT)
+        return slot_ids
+
+    def has_pending(self):
+        """
+        True if bids for this week may be waiting in `PendingBid`
+
+        Kept in the cache by `PendingBidManager`, so weeks without
+        pending bids don't have to look for them.
+        """
+        key = _pending_key(self.pk)
+        pending = cache.get(key)
+        if pending is None:
+            pending = PendingBid.objects.filter(week=self).exists()
+            # Don't overwrite a flag a submission set in the meantime
+            cache.add(key, pending, CACHE_TIMEOUT)
+        return pending
+
+    def slot_order(self):
+        """
+        Ids of the slots in this week in time order, from the cache
+        """
+        return _slot_order(self.pk)
+
+    def bid_pairs(self):
+        """
+        (slot id, user id) for every bid in this week, in one query
+        """
+        return bid_storage().pairs(self.pk)
+
+    def results(self):
+        """
+        The slots, winners and bidders of the week as plain data
+
+        Stored in the `CloseResult` when the week is closed, so the
+        closed week can be shown without reading its slots again.
+        """
+        winners, slot_field, user_field = winner_relation()
+        won = list(winners.objects
+                   .filter(**{slot_field + '__week': self})
+                   .order_by('pk')
+                   .values_list(slot_field, user_field))
+        users = get_user_model().objects.in_bulk(
+            [user_id for _, user_id in won])
+        slot_winners = defaultdict(list)
+        for slot_id, user_id in won:
+            slot_winners[slot_id].append(
+                [user_id, six.text_type(users[user_id])])
+        slot_bidders = defaultdict(list)
+        for slot_id, user_id in self.bid_pairs():
+            slot_bidders[slot_id].append(user_id)
+        return {
+            'slots': [{
+                'id': pk,
+                'time': slot_time.isoformat(),
+                'capacity': capacity,
+                'winners': slot_winners[pk],
+                'bidders': sorted(slot_bidders[pk]),
+            } for pk, slot_time, capacity
+                in self.slots.values_list('pk', 'time', 'capacity')],
+        }
+
+    def bid_slot_ids(self, user):
+        """
+        Set of ids of the slots in this week the user has bid for
+
+        Bids waiting in the `PendingBid` buffer count as placed.
+        """
+        if self.has_pending():
+            pending = PendingBid.objects.filter(week=self, user=user).first()
+            if pending is not None:
+                return set(pending.slot_ids)
+        return bid_storage().slot_ids(self.pk, user.pk)
+
+    @routers.primary()
+    def set_bids(self, user, slot_ids):
+        """
+        Replace the user's bids for this week with bids for `slot_ids`
+
+        How the bids are written depends on the `bid_storage`.  Ids of
+        slots that aren't in this week are ignored.  Pending bids of the
+        user are dropped.
+        """
+        with instrument('bid_submission') as values, transaction.atomic():
+            pending = PendingBid.objects.filter(week=self, user=user)
+            if pending.exists():
+                pending.delete()
+            wanted = self.slot_id_set() & set(slot_ids)
+            values.update(bid_storage().replace(self.pk, user.pk, wanted))
+        caching.bump(user_cache_name(user))
+        routers.pin_user(user)
+
+    def snapshot(self, strategy=allocation.GREEDY, flush=True):
+        """
+        The current input of the allocation as an allocation.Snapshot
+
+        Pending bids for the week are flushed first.  With `flush`
+        False nothing is written; the pending bids replace the stored
+        bids of their users in the snapshot instead.
+        """
+        if flush:
+            PendingBid.objects.flush([self])
+        slots = list(self.slots.annotate(num_winners=models.Count('winners'))
+                     .values_list('pk', 'capacity', 'num_winners'))
+        bids = list(self.bid_pairs())
+        if not flush and self.has_pending():
+            bids = self._with_pending(
+                bids, set(slot_id for slot_id, _, _ in slots))
+        return allocation.Snapshot(
+            slot_ids=[slot_id for slot_id, _, _ in slots],
+            open_slot_ids=[slot_id for slot_id, capacity, num_winners
+                           in slots if num_winners < capacity],
+            bids=bids,
+            win_counts=WinCount.objects.totals(
+                set(user_id for _, user_id in bids)),
+            seed=self.seed,
+            strategy=strategy,
+            capacities=dict(
+                (slot_id, capacity - num_winners)
+                for slot_id, capacity, num_winners in slots
+                if capacity - num_winners > 1))
+
+    def _with_pending(self, bids, slot_ids):
+        pending = list(PendingBid.objects.filter(week=self).order_by('pk'))
+        pending_users = set(row.user_id for row in pending)
+        return ([(slot_id, user_id) for slot_id, user_id in bids
+                 if user_id not in pending_users] +
+                [(slot_id, row.user_id) for row in pending
+                 for slot_id in row.slot_ids if slot_id in slot_ids])
+
+    @routers.primary()
+    def fill_slots(self, strategy=allocation.GREEDY, snapshot=None):
+        """
+        Pick winners for the open slots of this week
+
+        `strategy` is one of the strategies in
+        `timeslot_lottery.allocation.STRATEGIES`.  The default, greedy,
+        serves bidders first-come first-served and may leave slots
+        empty; flow (or matching) fills as many seats as possible.
+        Slots with a capacity above one get up to that many winners,
+        every bidder wins at most one slot.
+
+        Bidders with equal numbers of wins are shuffled with a random
+        generator seeded from `Week.seed`, so the same bids give the
+        same winners.  A `snapshot` from `Week.snapshot` can be passed
+        in instead of reading the bids again.
+
+        Returns:
+          A tuple of the newly won slots and the bidders who didn't win.
+          A slot that got several winners is in the list once for each,
+          as a copy with `winner` set to that winner.
+        """
+        with instrument('allocation') as values:
+            if snapshot is None:
+                snapshot = self.snapshot(strategy)
+            won_slots, remaining_bidders = self._fill_slots(snapshot)
+            filled = len(won_slots)
+            values.update(slots=len(snapshot.slot_ids),
+                          seats=snapshot.open_seats,
+                          bidders=filled + len(remaining_bidders),
+                          filled=filled)
+            if snapshot.open_seats:
+                values['fill_rate'] = float(filled) / snapshot.open_seats
+        return won_slots, remaining_bidders
+
+    def _fill_slots(self, snapshot):
+        now = timezone.now()
+        won, remaining_ids = snapshot.allocate()
+        users = get_user_model().objects.in_bulk(
+            [user_id for _, user_id in won] + remaining_ids)
+        slots = Slot.objects.in_bulk([slot_id for slot_id, _ in won])
         newly_won_slots = []
-        # Fill first-come first-served
-        for bidder in ordered_bidders:
-            for slot in remaining_slots:
-                if bidder in slot.bidders.all():
-                    slot.winner = bidder
-                    newly_won_slots.append(slot)
-                    remaining_slots.remove(slot)
-                    break
-            if not remaining_slots:
-                break
-        remaining_bidders = ordered_bidders[ordered_bidders.index(bidder):]
+        first_seats = []
+        for slot_id, user_id in won:
+            slot = slots[slot_id]
+            if slot.winner_id is None:
+                first_seats.append(slot)
+            else:
+                slot = copy.copy(slot)
+            slot.winner = users[user_id]
+            slot.modified = now
+            newly_won_slots.append(slot)
+        remaining_bidders = [users[user_id] for user_id in remaining_ids]
+        winners, slot_field, user_field = winner_relation()
         with transaction.atomic():
-            for slot in newly_won_slots:
-                slot.save()
+            # Saving the slots one by one would count every win
+            # separately, so update them and count the wins in bulk.
+            for slot in first_seats:
+                Slot.objects.filter(pk=slot.pk).update(
+                    winner=slot.winner, modified=now)
+            winners.objects.bulk_create([
+                winners(**{slot_field + '_id': slot.pk,
+                           user_field + '_id': slot.winner_id})
+                for slot in newly_won_slots])
+            WinCount.objects.add_wins(
+                self.template_id,
+                [slot.winner_id for slot in newly_won_slots])
         return newly_won_slots, remaining_bidders
 
-    def close(self):
+    @routers.primary()
+    def close(self, strategy=allocation.GREEDY):
+        """
+        Close the week and pick winners for its open slots
+
+        The week, the winners and a `CloseResult` with the final
+        `results` are saved together.  Closing a week that already has
+        a close result just returns the stored result.
+
+        Returns:
+          A tuple of the newly won slots and the bidders who didn't win.
+        """
+        try:
+            return self.close_result.as_tuple()
+        except CloseResult.DoesNotExist:
+            pass
+        start = time.time()
         now = timezone.now()
         if self.auto_close_from and now < self.auto_close_from:
             logger.warning(
-                "Closing week {s} before closing time {s.close_from}."
+                "Closing week {s} before closing time {s.auto_close_from}."
                 .format(s=self))
             self.auto_close_from = now
         if self.status == self.STATUS.closed:
             logger.info(
                 "Closing week {s} which has already been closed."
                 .format(s=self))
-        self.status = self.STATUS.closed
-        return self.fill_slots()
-
-    def _bidders_in_pick_order(self, bidders):
-        ordered_bidders = []
-        bidders_by_wins = collections.defaultdict(list)
-        # Group by number of wins
-        for bidder in bidders:
-            bidders_by_wins[bidder.num_wins].append(bidder)
-        for key in sorted(bidders_by_wins.keys()):
-            # Shuffle persons internally in each group
-            random.shuffle(bidders_by_wins[key])
-            # Build a full list of all bidders
-            ordered_bidders.extend(bidders_by_wins[key])
-        return ordered_bidders
+        with transaction.atomic():
+            self.status = self.STATUS.closed
+            snapshot = self.snapshot(strategy)
+            won_slots, remaining_bidders = self.fill_slots(
+                strategy, snapshot)
+            self.save()
+            self.close_result = CloseResult.objects.create(
+                week=self,
+                strategy=strategy,
+                seed=snapshot.seed,
+                snapshot=snapshot.to_json(),
+                allocation=[[slot.pk, slot.winner_id] for slot in won_slots],
+                remaining_bidders=[bidder.pk for bidder in remaining_bidders],
+                results=self.results(),
+                duration=time.time() - start)
+        caching.bump(self.template.cache_name, WEEKS_CACHE_NAME)
+        return won_slots, remaining_bidders
 
 
 class Slot(TimeStampedModel):
+    """
+    A time in a week that users bid for
+
+    Fields:
+      capacity  Number of winners the slot has room for.
+      winners   All the winners of the slot.
+      winner    The first winner.  Saving a slot with another `winner`
+                moves that seat in `winners` too.
+    """
     week = models.ForeignKey(Week, related_name='slots')
-    time = models.DateTimeField()
+    time = models.DateTimeField(db_index=True)
+    capacity = models.PositiveSmallIntegerField(default=1)
 
     winner = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True,
                                related_name='slots_won')
+    winners = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True,
+                                     related_name='seats_won')
     bidders = models.ManyToManyField(settings.AUTH_USER_MODEL,
                                      related_name='slots_bid_for')
 
@@ -212,3 +881,731 @@ class Slot(TimeStampedModel):
 
     def __unicode__(self):
         return "Slot {}".format(self.time)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            previous_winner_id = previous_time = None
+            if self.pk:
+                previous = (Slot.objects.filter(pk=self.pk)
+                            .values_list('winner', 'time').first())
+                if previous is not None:
+                    previous_winner_id, previous_time = previous
+            # New and moved slots change the order of the week's slots
+            reordered = previous_time != self.time
+            masks = _uses_bid_masks()
+            if reordered and masks:
+                old_order = BidMask.objects.used_order(self.week_id)
+            super(Slot, self).save(*args, **kwargs)
+            if reordered:
+                caching.bump('week-{}'.format(self.week_id))
+            if reordered and masks:
+                BidMask.objects.reorder(self.week_id, old_order)
+            if previous_winner_id != self.winner_id:
+                self._move_win(previous_winner_id, self.winner_id)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            winner_ids = list(self.winners.values_list('pk', flat=True))
+            template_id = self._template_id()
+            super(Slot, self).delete(*args, **kwargs)
+            WinCount.objects.add_wins(template_id, winner_ids, -1)
+
+    def _move_win(self, from_user_id, to_user_id):
+        """
+        Keep the winners and win counters in line with a changed winner
+        """
+        if not from_user_id and not to_user_id:
+            return
+        template_id = self._template_id()
+        if from_user_id:
+            self.winners.remove(from_user_id)
+            WinCount.objects.add_wins(template_id, [from_user_id], -1)
+        if to_user_id:
+            self.winners.add(to_user_id)
+            WinCount.objects.add_wins(template_id, [to_user_id])
+
+    def _template_id(self):
+        return (Week.objects.values_list('template', flat=True)
+                .get(pk=self.week_id))
+
+
+class CloseResult(TimeStampedModel):
+    """
+    What happened when a week was closed
+
+    Fields:
+      allocation         List of [slot id, user id] pairs for the slots
+                         won in the close, in pick order.
+      remaining_bidders  Ids of the bidders who didn't win, in pick order.
+      duration           Seconds used to close the week.
+      snapshot           The allocation input, see allocation.Snapshot.
+      results            The slots, winners and bidders of the closed
+                         week, see `Week.results`.
+    """
+    week = models.OneToOneField(Week, related_name='close_result')
+    strategy = models.CharField(max_length=32)
+    seed = models.PositiveIntegerField(blank=True, null=True)
+    snapshot = JSONField(blank=True, null=True)
+    allocation = JSONField(default=[])
+    remaining_bidders = JSONField(default=[])
+    results = JSONField(blank=True, null=True)
+    duration = models.FloatField()
+
+    def __unicode__(self):
+        return "Close result for {}".format(self.week_id)
+
+    def final_results(self):
+        """
+        The stored `results`, storing them first for older close results
+        """
+        if self.results is None:
+            self.results = self.week.results()
+            CloseResult.objects.filter(pk=self.pk).update(
+                results=self.results)
+        return self.results
+
+    def slots(self, user=None):
+        """
+        Unsaved slots of the week made from the results
+
+        Like the slots shown for an open week, they have `num_bids`,
+        `winner_list` and `has_user_bid` for `user`.
+        """
+        user_id = getattr(user, 'pk', None)
+        slots = []
+        for data in self.final_results()['slots']:
+            slot = Slot(pk=data['id'], week_id=self.week_id,
+                        time=parse_datetime(data['time']),
+                        capacity=data['capacity'])
+            slot.num_bids = len(data['bidders'])
+            slot.winner_list = [name for _, name in data['winners']]
+            slot.has_user_bid = user_id in data['bidders']
+            slots.append(slot)
+        return slots
+
+    def replay(self):
+        """
+        Allocate again from the stored snapshot
+
+        Returns:
+          The allocation and remaining bidders, in the form they are
+          stored, or None for results stored without a snapshot.
+        """
+        if not self.snapshot:
+            return None
+        won, remaining_ids = (allocation.Snapshot
+                              .from_json(self.snapshot).allocate())
+        return [list(pair) for pair in won], remaining_ids
+
+    def verify(self):
+        """
+        True if replaying the snapshot gives the stored result
+        """
+        return self.replay() == (self.allocation, self.remaining_bidders)
+
+    def as_tuple(self):
+        """
+        The won slots and remaining bidders, like `Week.close` returns
+        """
+        slots = Slot.objects.in_bulk([pk for pk, _ in self.allocation])
+        users = (get_user_model().objects.in_bulk(
+            [pk for _, pk in self.allocation] + self.remaining_bidders))
+        won_slots = []
+        for slot_id, user_id in self.allocation:
+            # A slot with several winners is in the list once for each
+            slot = copy.copy(slots[slot_id])
+            slot.winner = users[user_id]
+            won_slots.append(slot)
+        return (won_slots,
+                [users[user_id] for user_id in self.remaining_bidders])
+
+
+class WinCountManager(models.Manager):
+    def totals(self, user_ids):
+        """
+        Dict from user id to number of wins in all templates
+        """
+        return dict(self.filter(user__in=user_ids)
+                    .values_list('user')
+                    .annotate(models.Sum('count')))
+
+    def add_wins(self, template_id, user_ids, step=1):
+        """
+        Add `step` wins in the template to each of the users
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        counts = self.filter(template=template_id, user__in=user_ids)
+        with transaction.atomic():
+            existing = set(counts.values_list('user', flat=True))
+            counts.update(count=models.F('count') + step)
+            self.bulk_create([
+                WinCount(template_id=template_id, user_id=user_id,
+                         count=max(step, 0))
+                for user_id in user_ids - existing])
+
+    def rebuild(self):
+        """
+        Recount all wins from the slot winners
+
+        Returns:
+          The number of counters.
+        """
+        winners, slot_field, user_field = winner_relation()
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create([
+                WinCount(template_id=template_id, user_id=user_id,
+                         count=count)
+                for user_id, template_id, count
+                in (winners.objects
+                    .values_list(user_field, slot_field + '__week__template')
+                    .annotate(models.Count('pk'))
+                    .order_by())])
+            return self.count()
+
+
+class WinCount(models.Model):
+    """
+    Number of slots a user has won in a template
+
+    Kept up to date when slot winners change, so that the pick order
+    doesn't have to count the full win history of every bidder.  Slot
+    updates that bypass `Slot.save` must be followed up by running the
+    rebuild_win_counts management command.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             related_name='win_counts')
+    template = models.ForeignKey(Template, related_name='win_counts')
+    count = models.PositiveIntegerField(default=0)
+
+    objects = WinCountManager()
+
+    class Meta:
+        unique_together = ('user', 'template')
+
+    def __unicode__(self):
+        return "{} wins for {}".format(self.count, self.user_id)
+
+
+class PendingBidManager(models.Manager):
+    def submit(self, week, user, slot_ids):
+        """
+        Buffer the user's bids for the week
+
+        Replaces any bids of the user still pending for the week.
+        """
+        slot_ids = sorted(set(slot_ids))
+        pending = self.filter(week=week, user=user)
+        if not pending.update(slot_ids=slot_ids, modified=timezone.now()):
+            try:
+                with transaction.atomic():
+                    self.create(week=week, user=user, slot_ids=slot_ids)
+            except IntegrityError:
+                # Another request created it in the meantime
+                pending.update(slot_ids=slot_ids, modified=timezone.now())
+        cache.set(_pending_key(week.pk), True, CACHE_TIMEOUT)
+        caching.bump(user_cache_name(user))
+        routers.pin_user(user)
+
+    @routers.primary()
+    def flush(self, weeks=None):
+        """
+        Write pending bids to the `bid_storage`
+
+        Every pending user's bids in a week are replaced by the pending
+        bids, in batches.  Pending bids for weeks that are already closed
+        are dropped, the lottery is over for them.
+
+        Arguments:
+          weeks  Weeks to flush, defaults to all.
+
+        Returns:
+          The number of pending users whose bids were written.
+        """
+        pending = self.all()
+        if weeks is not None:
+            pending = pending.filter(week__in=weeks)
+        with transaction.atomic():
+            rows = list(pending.select_for_update().order_by('pk'))
+            if not rows:
+                return 0
+            week_ids = set(row.week_id for row in rows)
+            closed = set(Week.objects.filter(pk__in=week_ids,
+                                             status=Week.STATUS.closed)
+                         .values_list('pk', flat=True))
+            open_rows = [row for row in rows if row.week_id not in closed]
+            with instrument('bid_flush', users=len(open_rows)) as values:
+                slot_weeks = dict(Slot.objects.filter(week__in=week_ids)
+                                  .values_list('pk', 'week'))
+                bids = dict(
+                    ((row.week_id, row.user_id),
+                     set(slot_id for slot_id in row.slot_ids
+                         if slot_weeks.get(slot_id) == row.week_id))
+                    for row in open_rows)
+                values['bids'] = bid_storage().replace_many(bids)
+                for chunk in _chunks([row.pk for row in rows]):
+                    self.filter(pk__in=chunk).delete()
+        # Unknown rather than False, a submission may have come in since
+        cache.delete_many([_pending_key(week_id) for week_id in week_ids])
+        return len(open_rows)
+
+
+class PendingBid(TimeStampedModel):
+    """
+    Bids of a user for a week, waiting to be written to the bid storage
+
+    Bids submitted through the JSON endpoint are buffered here, so a
+    submission is a single write.  `PendingBidManager.flush` moves them
+    to the `bid_storage` in bulk; it runs before a week's bids are read
+    for allocation, and from the flush_pending_bids command.
+    """
+    week = models.ForeignKey(Week, related_name='pending_bids')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             related_name='pending_bids')
+    slot_ids = JSONField(default=[])
+
+    objects = PendingBidManager()
+
+    class Meta:
+        unique_together = ('week', 'user')
+
+    def __unicode__(self):
+        return "Pending bids of {} for {}".format(self.user_id, self.week_id)
+
+
+class BidMaskManager(models.Manager):
+    def used_order(self, week_id):
+        """
+        The slot order of the week if it has bid masks, else None
+        """
+        if not self.filter(week=week_id).exists():
+            return None
+        return list(Slot.objects.filter(week=week_id)
+                    .order_by('time', 'pk').values_list('pk', flat=True))
+
+    def reorder(self, week_id, old_order):
+        """
+        Rewrite the week's masks after its slots changed
+
+        `old_order` is the slot order the masks were written in, from
+        `used_order`.  Only masks still written in `old_order` are
+        rewritten, so reordering again with the same `old_order` does
+        nothing.
+        """
+        if old_order is None:
+            return
+        new_order = _slot_order(week_id, fresh=True)
+        order_hash = _order_hash(new_order)
+        for bid_mask in self.filter(week=week_id,
+                                    order_hash=_order_hash(old_order)):
+            bid_mask.mask = encode_mask(
+                decode_mask(bid_mask.mask, old_order), new_order)
+            bid_mask.order_hash = order_hash
+            bid_mask.save()
+
+
+class BidMask(TimeStampedModel):
+    """
+    All bids of a user for a week, as a bitmask over the week's slots
+
+    Used instead of Slot.bidders when TIMESLOT_LOTTERY_BID_STORAGE is
+    'bitmask'.  Bit i is set if the user bid for slot i of
+    `Week.slot_order`, the slots in time order.  The mask is stored as
+    hex, as it's wider than any integer column for big weeks.
+    `order_hash` identifies the slot order the mask was written in, so
+    a stale cached order is noticed instead of misreading the mask.
+    """
+    week = models.ForeignKey(Week, related_name='bid_masks')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             related_name='bid_masks')
+    mask = models.TextField()
+    order_hash = models.CharField(max_length=16)
+
+    objects = BidMaskManager()
+
+    class Meta:
+        unique_together = ('week', 'user')
+
+    def __unicode__(self):
+        return "Bids of {} for {}".format(self.user_id, self.week_id)
+
+
+def encode_mask(slot_ids, order):
+    """
+    Hex bitmask of the slots, by their position in `order`
+    """
+    index = dict((slot_id, i) for i, slot_id in enumerate(order))
+    mask = 0
+    for slot_id in slot_ids:
+        if slot_id in index:
+            mask |= 1 << index[slot_id]
+    return '{:x}'.format(mask)
+
+
+def decode_mask(mask, order):
+    """
+    Ids of the slots set in a hex bitmask, in `order`
+    """
+    mask = int(mask, 16)
+    slot_ids = []
+    while mask:
+        bit = mask & -mask
+        i = bit.bit_length() - 1
+        if i >= len(order):
+            break
+        slot_ids.append(order[i])
+        mask ^= bit
+    return slot_ids
+
+
+class M2MBidStorage(object):
+    """
+    Bids as rows of the Slot.bidders table, one per bid
+    """
+    def pairs(self, week_id):
+        "(slot id, user id) for every bid in the week"
+        through, slot_field, user_field = bid_relation()
+        return (through.objects
+                .filter(**{slot_field + '__week': week_id})
+                .values_list(slot_field, user_field))
+
+    def slot_ids(self, week_id, user_id):
+        "Set of ids of the slots in the week the user bid for"
+        through, slot_field, user_field = bid_relation()
+        return set(through.objects
+                   .filter(**{slot_field + '__week': week_id,
+                              user_field: user_id})
+                   .values_list(slot_field, flat=True))
+
+    def user_bids(self, week_ids, user_id):
+        "Dict from id of every slot the user bid for to its week id"
+        through, slot_field, user_field = bid_relation()
+        return dict(through.objects
+                    .filter(**{slot_field + '__week__in': week_ids,
+                               user_field: user_id})
+                    .values_list(slot_field, slot_field + '__week'))
+
+    def bidders(self, slot_ids):
+        "Dict from slot id to the sorted ids of the users who bid for it"
+        through, slot_field, user_field = bid_relation()
+        bidders = dict((slot_id, []) for slot_id in slot_ids)
+        for slot_id, user_id in (through.objects
+                                 .filter(**{slot_field + '__in': slot_ids})
+                                 .order_by(slot_field, user_field)
+                                 .values_list(slot_field, user_field)
+                                 .iterator()):
+            bidders[slot_id].append(user_id)
+        return bidders
+
+    def with_bid_counts(self, slots, week_id):
+        "The slots of a queryset, with `num_bids`"
+        return list(slots.annotate(num_bids=models.Count('bidders')))
+
+    def replace(self, week_id, user_id, slot_ids):
+        """
+        Replace the user's bids for the week
+
+        Only the difference to the existing bids is written, with one
+        bulk insert and one bulk delete.
+
+        Returns:
+          A dict of numbers for the instrumentation.
+        """
+        through, slot_field, user_field = bid_relation()
+        bids = through.objects.filter(
+            **{slot_field + '__week': week_id, user_field: user_id})
+        existing = set(bids.values_list(slot_field, flat=True))
+        if existing - slot_ids:
+            bids.filter(**{slot_field + '__in': existing - slot_ids}).delete()
+        if slot_ids - existing:
+            through.objects.bulk_create([
+                through(**{slot_field + '_id': slot_id,
+                           user_field + '_id': user_id})
+                for slot_id in slot_ids - existing])
+        return {'added': len(slot_ids - existing),
+                'removed': len(existing - slot_ids)}
+
+    def replace_many(self, bids):
+        """
+        Replace the bids of many users
+
+        Arguments:
+          bids  Dict from (week id, user id) to a set of slot ids.
+
+        Returns:
+          The number of bids written.
+        """
+        through, slot_field, user_field = bid_relation()
+        user_ids = defaultdict(list)
+        for week_id, user_id in bids:
+            user_ids[week_id].append(user_id)
+        for week_id, week_user_ids in user_ids.items():
+            for chunk in _chunks(week_user_ids):
+                through.objects.filter(**{
+                    slot_field + '__week': week_id,
+                    user_field + '__in': chunk}).delete()
+        new_bids = [through(**{slot_field + '_id': slot_id,
+                               user_field + '_id': user_id})
+                    for (_, user_id), slot_ids in bids.items()
+                    for slot_id in slot_ids]
+        through.objects.bulk_create(new_bids, batch_size=FLUSH_BATCH_SIZE)
+        return len(new_bids)
+
+    def clear(self, week_id):
+        "Delete all bids for the week"
+        through, slot_field, user_field = bid_relation()
+        through.objects.filter(**{slot_field + '__week': week_id}).delete()
+
+
+class BitmaskBidStorage(object):
+    """
+    Bids as `BidMask` rows, one per user and week
+    """
+    def pairs(self, week_id):
+        "(slot id, user id) for every bid in the week"
+        decode = _MaskDecoder()
+        return [(slot_id, user_id)
+                for user_id, mask, order_hash
+                in (BidMask.objects.filter(week=week_id)
+                    .values_list('user', 'mask', 'order_hash').iterator())
+                for slot_id in decode(week_id, mask, order_hash)]
+
+    def slot_ids(self, week_id, user_id):
+        "Set of ids of the slots in the week the user bid for"
+        bid_mask = (BidMask.objects.filter(week=week_id, user=user_id)
+                    .values_list('mask', 'order_hash').first())
+        if bid_mask is None:
+            return set()
+        return set(_MaskDecoder()(week_id, *bid_mask))
+
+    def user_bids(self, week_ids, user_id):
+        "Dict from id of every slot the user bid for to its week id"
+        decode = _MaskDecoder()
+        return dict(
+            (slot_id, week_id)
+            for week_id, mask, order_hash
+            in (BidMask.objects.filter(week__in=week_ids, user=user_id)
+                .values_list('week', 'mask', 'order_hash'))
+            for slot_id in decode(week_id, mask, order_hash))
+
+    def bidders(self, slot_ids):
+        "Dict from slot id to the sorted ids of the users who bid for it"
+        bidders = dict((slot_id, []) for slot_id in slot_ids)
+        week_ids = set(Slot.objects.filter(pk__in=slot_ids)
+                       .values_list('week', flat=True))
+        for week_id in week_ids:
+            for slot_id, user_id in self.pairs(week_id):
+                if slot_id in bidders:
+                    bidders[slot_id].append(user_id)
+        for user_ids in bidders.values():
+            user_ids.sort()
+        return bidders
+
+    def with_bid_counts(self, slots, week_id):
+        "The slots of a queryset, with `num_bids`"
+        counts = defaultdict(int)
+        for slot_id, _ in self.pairs(week_id):
+            counts[slot_id] += 1
+        slots = list(slots)
+        for slot in slots:
+            slot.num_bids = counts[slot.pk]
+        return slots
+
+    def replace(self, week_id, user_id, slot_ids):
+        """
+        Replace the user's bids for the week with one upsert
+
+        Returns:
+          A dict of numbers for the instrumentation.
+        """
+        order = _slot_order(week_id, fresh=True)
+        fields = {'mask': encode_mask(slot_ids, order),
+                  'order_hash': _order_hash(order)}
+        bid_masks = BidMask.objects.filter(week=week_id, user=user_id)
+        if fields['mask'] == '0':
+            bid_masks.delete()
+        elif not bid_masks.update(modified=timezone.now(), **fields):
+            try:
+                with transaction.atomic():
+                    BidMask.objects.create(week_id=week_id, user_id=user_id,
+                                           **fields)
+            except IntegrityError:
+                # Another request created it in the meantime
+                bid_masks.update(modified=timezone.now(), **fields)
+        return {'bids': len(slot_ids)}
+
+    def replace_many(self, bids):
+        """
+        Replace the bids of many users
+
+        Arguments:
+          bids  Dict from (week id, user id) to a set of slot ids.
+
+        Returns:
+          The number of bids written.
+        """
+        user_ids = defaultdict(list)
+        for week_id, user_id in bids:
+            user_ids[week_id].append(user_id)
+        orders = {}
+        for week_id, week_user_ids in user_ids.items():
+            orders[week_id] = _slot_order(week_id, fresh=True)
+            for chunk in _chunks(week_user_ids):
+                BidMask.objects.filter(week=week_id,
+                                       user__in=chunk).delete()
+        BidMask.objects.bulk_create([
+            BidMask(week_id=week_id, user_id=user_id,
+                    mask=encode_mask(slot_ids, orders[week_id]),
+                    order_hash=_order_hash(orders[week_id]))
+            for (week_id, user_id), slot_ids in bids.items() if slot_ids],
+            batch_size=FLUSH_BATCH_SIZE)
+        return sum(len(slot_ids) for slot_ids in bids.values())
+
+    def clear(self, week_id):
+        "Delete all bids for the week"
+        BidMask.objects.filter(week=week_id).delete()
+
+
+BID_STORAGES = {
+    'm2m': M2MBidStorage(),
+    'bitmask': BitmaskBidStorage(),
+}
+
+
+def convert_bids(to, weeks=None):
+    """
+    Move bids from the other storage to the `to` storage
+
+    Every week is moved in its own transaction, so the conversion can
+    run in pieces.  Switch TIMESLOT_LOTTERY_BID_STORAGE to `to` once it
+    is done.
+
+    Arguments:
+      to     'm2m' or 'bitmask'.
+      weeks  Weeks to convert, defaults to all.
+
+    Returns:
+      The number of bids moved.
+    """
+    target = BID_STORAGES[to]
+    source = [storage for name, storage in BID_STORAGES.items()
+              if name != to][0]
+    if weeks is None:
+        weeks = Week.objects.all()
+    moved = 0
+    for week_id in list(weeks.values_list('pk', flat=True)):
+        with transaction.atomic():
+            bids = defaultdict(set)
+            for slot_id, user_id in source.pairs(week_id):
+                bids[week_id, user_id].add(slot_id)
+            if bids:
+                moved += target.replace_many(bids)
+                source.clear(week_id)
+    return moved
+
+
+def _pending_key(week_id):
+    return caching.make_key('week-{}'.format(week_id), 'pending')
+
+
+def _slot_order(week_id, fresh=False):
+    """
+    Ids of the week's slots in time order, the bit order of `BidMask`
+
+    Read from the cache unless `fresh`.  Masks are always written with a
+    fresh order; when reading, `_MaskDecoder` checks the cached order
+    against the mask's `order_hash`.
+    """
+    key = caching.make_key('week-{}'.format(week_id), 'slot-order')
+    order = None if fresh else cache.get(key)
+    if order is None:
+        order = list(Slot.objects.filter(week=week_id)
+                     .order_by('time', 'pk').values_list('pk', flat=True))
+        cache.set(key, order, CACHE_TIMEOUT)
+    return order
+
+
+def _order_hash(order):
+    "Short hash of a slot order, stored with the masks written in it"
+    return hashlib.sha1(
+        ','.join(str(slot_id) for slot_id in order).encode('ascii')
+    ).hexdigest()[:16]
+
+
+class _MaskDecoder(object):
+    """
+    Decodes bid masks in the slot order they were written in
+
+    The cached slot order is used while it matches the masks.  If it
+    doesn't, the order is read again from the database once per week.
+    A mask that matches neither was written for slots that have since
+    changed through a queryset update; it can't be read, so it's
+    skipped.
+    """
+    def __init__(self):
+        self.orders = {}
+        self.reloaded = set()
+
+    def __call__(self, week_id, mask, order_hash):
+        orders = self.orders.get(week_id)
+        if orders is None:
+            order = _slot_order(week_id)
+            orders = self.orders[week_id] = {_order_hash(order): order}
+        if order_hash not in orders and week_id not in self.reloaded:
+            self.reloaded.add(week_id)
+            order = _slot_order(week_id, fresh=True)
+            orders[_order_hash(order)] = order
+        if order_hash not in orders:
+            logger.error("Bid mask of week {} was written for other slots, "
+                         "skipping it.".format(week_id))
+            return []
+        return decode_mask(mask, orders[order_hash])
+
+
+@receiver(pre_delete, sender=Slot)
+def _slot_pre_delete(sender, instance, **kwargs):
+    # Sent for queryset deletes too, which don't call Slot.delete
+    if _uses_bid_masks():
+        instance._mask_order = BidMask.objects.used_order(instance.week_id)
+
+
+@receiver(post_delete, sender=Slot)
+def _slot_post_delete(sender, instance, **kwargs):
+    caching.bump('week-{}'.format(instance.week_id))
+    old_order = getattr(instance, '_mask_order', None)
+    if old_order is not None:
+        # Slots deleted together share the old order, only the first
+        # finds masks left to rewrite
+        BidMask.objects.reorder(instance.week_id, old_order)
+
+
+def _uses_bid_masks():
+    "True if bids are stored as `BidMask` rows"
+    return isinstance(bid_storage(), BitmaskBidStorage)
+
+
+def _chunks(items, size=FLUSH_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bid_relation():
+    """
+    The Slot.bidders through model and its slot and user field names
+    """
+    return _m2m_relation('bidders')
+
+
+def winner_relation():
+    """
+    The Slot.winners through model and its slot and user field names
+    """
+    return _m2m_relation('winners')
+
+
+def _m2m_relation(name):
+    field = Slot._meta.get_field(name)
+    return (field.rel.through,
+            field.m2m_field_name(), field.m2m_reverse_field_name())
@@ -0,0 +1,158 @@
+"""
+Emails telling winners which slot they got
+"""
+import logging
+import smtplib
+import socket
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail import get_connection
+from django.template import Context
+from django.template.loader import get_template
+
+from timeslot_lottery.instrumentation import instrument
+from timeslot_lottery.models import winner_relation
+
+
+logger = logging.getLogger(__name__)
+
+
+class WinnerEmails(object):
+    """
+    Renders winner emails, loading the templates only once
+    """
+    def __init__(self):
+        self.text_template = get_template(
+            'timeslot_lottery/emails/winner.txt')
+        self.html_template = get_template(
+            'timeslot_lottery/emails/winner.html')
+        self.from_email = getattr(settings, 'TIMESLOT_LOTTERY_FROM_EMAIL',
+                                  "skriv@nynorsk.no")
+
+    def render(self, user, slot, week=None):
+        """
+        Text and html body of the email to `user` about `slot`
+        """
+        week = week or slot.week
+        ctx = Context({
+            'slot': slot,
+            'template': week.template,
+            'user': user,
+            'week': week,
+        })
+        return self.text_template.render(ctx), self.html_template.render(ctx)
+
+    def message(self, slot, week=None):
+        """
+        Email to the winner of `slot`, or None if they have no address
+        """
+        user = slot.winner
+        if not user.email:
+            return None
+        week = week or slot.week
+        text_body, html_body = self.render(user, slot, week)
+        title = "Got slot for {w.template} {w}".format(w=week)
+        msg = EmailMultiAlternatives(title, text_body, self.from_email,
+                                     [user.email])
+        msg.attach_alternative(html_body, 'text/html')
+        return msg
+
+
+def notify_week_winners(week, winner_slots=None, **kwargs):
+    """
+    Email the winners of a week
+
+    Arguments:
+      week          The week.  Its template is fetched once, and used for
+                    all the slots.
+      winner_slots  Slots of the week to notify about, with `winner` set
+                    to the user to email.  Defaults to every seat won in
+                    the week.
+
+    Any other keyword arguments are passed on to `send_messages`.
+
+    Returns:
+      The number of emails sent.
+    """
+    with instrument('notification') as values:
+        if winner_slots is None:
+            winner_slots = _won_seats('__week', week)
+        emails = WinnerEmails()
+        messages = [emails.message(slot, week) for slot in winner_slots]
+        sent = send_messages([msg for msg in messages if msg], **kwargs)
+        values['emails'] = sent
+    return sent
+
+
+def notify_winners(weeks, **kwargs):
+    """
+    Email the winners of many weeks over one connection
+
+    The seats won in all the weeks are fetched in one query.  Any
+    keyword arguments are passed on to `send_messages`.
+
+    Returns:
+      The number of emails sent.
+    """
+    with instrument('notification') as values:
+        winner_slots = _won_seats('__week__in', weeks, '__week__template')
+        emails = WinnerEmails()
+        messages = [emails.message(slot) for slot in winner_slots]
+        sent = send_messages([msg for msg in messages if msg], **kwargs)
+        values['emails'] = sent
+    return sent
+
+
+def _won_seats(lookup, value, related=''):
+    """
+    A slot for every seat won, with `winner` set to the seat's winner
+
+    `lookup` filters the slots, `related` names slot relations to fetch
+    along.
+    """
+    winners, slot_field, user_field = winner_relation()
+    seats = (winners.objects.filter(**{slot_field + lookup: value})
+             .select_related(slot_field + related, user_field))
+    for seat in seats:
+        slot = getattr(seat, slot_field)
+        slot.winner = getattr(seat, user_field)
+        yield slot
+
+
+def send_messages(messages, connection=None, batch_size=100,
+                  retries=3, backoff=1.0):
+    """
+    Send emails in batches over one connection
+
+    A batch that fails with an SMTP or socket error is sent again after
+    `backoff` seconds, doubling the wait every time, at most `retries`
+    times.  Messages sent before the failure in a failed batch may be
+    sent twice.
+
+    Returns:
+      The number of emails sent.
+    """
+    connection = connection or get_connection()
+    sent = 0
+    connection.open()
+    try:
+        for start in range(0, len(messages), batch_size):
+            batch = messages[start:start + batch_size]
+            for attempt in range(retries + 1):
+                try:
+                    sent += connection.send_messages(batch) or 0
+                    break
+                except (smtplib.SMTPException, socket.error):
+                    if attempt == retries:
+                        raise
+                    logger.warning(
+                        "Sending {} emails failed, retrying."
+                        .format(len(batch)), exc_info=True)
+                    connection.close()
+                    time.sleep(backoff * 2 ** attempt)
+                    connection.open()
+    finally:
+        connection.close()
+    return sent
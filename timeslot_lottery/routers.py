@@ -0,0 +1,133 @@
+"""
+Database routing between a primary and a read replica
+
+Add the router and the middleware to the settings:
+
+    DATABASE_ROUTERS = ['timeslot_lottery.routers.LotteryRouter']
+    MIDDLEWARE_CLASSES += [
+        'timeslot_lottery.routers.PinnedUserMiddleware']
+    TIMESLOT_LOTTERY_REPLICA = 'replica'
+
+Reads of the lottery's models then go to the replica database, except
+inside `primary()`, which closing weeks, allocation, creating weeks and
+bidding all run in.  A user who has just bid is pinned to the primary for
+TIMESLOT_LOTTERY_PIN_SECONDS, so they see their own bids while the
+replica catches up.
+"""
+import functools
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+
+APP_LABEL = 'timeslot_lottery'
+
+_state = threading.local()
+
+
+def replica():
+    "Alias of the replica database, or None"
+    return getattr(settings, 'TIMESLOT_LOTTERY_REPLICA', None)
+
+
+def pin_seconds():
+    return getattr(settings, 'TIMESLOT_LOTTERY_PIN_SECONDS', 10)
+
+
+class primary(object):
+    """
+    Read from the primary database in this thread
+
+    Used as a context manager or a function decorator.
+    """
+    def __enter__(self):
+        _state.primary = getattr(_state, 'primary', 0) + 1
+
+    def __exit__(self, *exc_info):
+        _state.primary -= 1
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def on_primary():
+    "True if reads in this thread must go to the primary"
+    return bool(getattr(_state, 'primary', 0) or
+                getattr(_state, 'user_pinned', False))
+
+
+def pin_user(user):
+    """
+    Send the user's reads to the primary for a while
+
+    Takes effect at once if the current request went through
+    `PinnedUserMiddleware`.
+    """
+    if replica() is None or user.pk is None:
+        return
+    cache.set(_pin_key(user), True, pin_seconds())
+    if getattr(_state, 'in_request', False):
+        _state.user_pinned = True
+
+
+class PinnedUserMiddleware(object):
+    """
+    Reads for users pinned by `pin_user` go to the primary
+
+    Must come after AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        _state.in_request = True
+        user = getattr(request, 'user', None)
+        _state.user_pinned = bool(
+            replica() is not None and user is not None and
+            user.is_authenticated() and cache.get(_pin_key(user)))
+
+    def process_response(self, request, response):
+        _state.in_request = _state.user_pinned = False
+        return response
+
+    def process_exception(self, request, exception):
+        _state.in_request = _state.user_pinned = False
+
+
+class LotteryRouter(object):
+    """
+    Reads of lottery models from the replica, everything else on primary
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL or replica() is None:
+            return None
+        if on_primary():
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Follow relations on the database the object came from
+            return instance._state.db
+        return replica()
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (DEFAULT_DB_ALIAS, replica())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, model):
+        if model._meta.app_label != APP_LABEL or replica() is None:
+            return None
+        return db == DEFAULT_DB_ALIAS
+
+
+def _pin_key(user):
+    return 'timeslot_lottery:pinned:{}'.format(user.pk)
@@ -0,0 +1,151 @@
+"""
+Compiled weekly schedules
+
+`Template.slots` is a JSON dict from ISO weekday to 'HH:MM' strings, or
+['HH:MM', capacity] pairs for slots with room for more than one winner.
+It is parsed and validated once into a `Schedule`, where every slot is a
+number of minutes since Monday 00:00, and the datetimes of any week are
+found by adding those offsets to the week's Monday.
+"""
+from array import array
+import datetime
+import json
+import re
+
+from django.core.exceptions import ValidationError
+from django.utils import six
+from django.utils.lru_cache import lru_cache
+
+
+DAY_NAMES = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+             'Saturday', 'Sunday')
+MINUTES_PER_DAY = 24 * 60
+# Largest value of Slot.capacity, a signed smallint in some databases
+MAX_CAPACITY = 2 ** 15 - 1
+
+_TIME_RE = re.compile(r'^(\d{1,2}):(\d{2})$')
+
+
+class Schedule(object):
+    """
+    Slot times and opening and closing times of a week
+
+    Attributes:
+      offsets     Sorted array of minutes since Monday 00:00, one per slot.
+      capacities  Array of the number of winners of every slot.
+      opening     Timedelta since Monday 00:00 when the week opens, or
+                  None.
+      closing     Timedelta since Monday 00:00 when the week closes, or
+                  None.  May be more than a week.
+    """
+    def __init__(self, offsets, opening=None, closing=None,
+                 capacities=None):
+        if capacities is None:
+            capacities = [1] * len(offsets)
+        slots = sorted(zip(offsets, capacities))
+        self.offsets = array('H', [offset for offset, _ in slots])
+        self.capacities = array('H', [capacity for _, capacity in slots])
+        self.opening = opening
+        self.closing = closing
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def datetimes(self, week_start):
+        """
+        Datetimes of the slots in the week starting at the date given
+        """
+        monday = datetime.datetime.combine(week_start, datetime.time())
+        return [monday + datetime.timedelta(minutes=offset)
+                for offset in self.offsets]
+
+    def opening_time(self, week_start):
+        if self.opening is None:
+            return None
+        return datetime.datetime.combine(week_start,
+                                         datetime.time()) + self.opening
+
+    def closing_time(self, week_start):
+        if self.closing is None:
+            return None
+        return datetime.datetime.combine(week_start,
+                                         datetime.time()) + self.closing
+
+    @property
+    def days(self):
+        """
+        List of (day name, list of times) for the days with slots
+        """
+        days = []
+        for offset in self.offsets:
+            day, minute = divmod(offset, MINUTES_PER_DAY)
+            if not days or days[-1][0] != DAY_NAMES[day]:
+                days.append((DAY_NAMES[day], []))
+            days[-1][1].append(datetime.time(*divmod(minute, 60)))
+        return days
+
+
+def compile_schedule(slots, auto_opening=None, auto_closing=None):
+    """
+    The `Schedule` for a template's slots, opening and closing
+
+    Schedules are cached on the arguments, so templates that haven't
+    changed don't get parsed again.
+
+    Raises:
+      ValidationError if the slots are malformed.
+    """
+    opening = closing = None
+    if auto_opening:
+        opening = datetime.timedelta(
+            days=auto_opening.isoweekday() - 1,
+            hours=auto_opening.hour, minutes=auto_opening.minute,
+            seconds=auto_opening.second,
+            microseconds=auto_opening.microsecond)
+        if auto_closing:
+            closing = opening + (auto_closing - auto_opening)
+    return _compile(json.dumps(slots, sort_keys=True), opening, closing)
+
+
+@lru_cache(maxsize=512)
+def _compile(slots_json, opening, closing):
+    slots = parse_slots(json.loads(slots_json))
+    return Schedule([offset for offset, _ in slots], opening, closing,
+                    [capacity for _, capacity in slots])
+
+
+def parse_slots(slots):
+    """
+    (minutes since Monday 00:00, capacity) for every time in a slots dict
+
+    Raises:
+      ValidationError if the slots are malformed.
+    """
+    if not isinstance(slots, dict):
+        raise ValidationError("Slots must be a dict of days to times")
+    parsed = []
+    for day_key, times in slots.items():
+        day = int(day_key) if str(day_key).isdigit() else None
+        if day not in range(1, 8):
+            raise ValidationError(
+                "Day {!r} is not a weekday between 1 and 7".format(day_key))
+        if not isinstance(times, list):
+            raise ValidationError("Times must be a list of 'HH:MM'")
+        for time in times:
+            capacity = 1
+            if isinstance(time, list) and len(time) == 2:
+                time, capacity = time
+            if (not isinstance(capacity, six.integer_types) or
+                    not 1 <= capacity <= MAX_CAPACITY):
+                raise ValidationError(
+                    "Capacity {!r} is not a number from 1 to {}"
+                    .format(capacity, MAX_CAPACITY))
+            match = (isinstance(time, six.string_types) and
+                     _TIME_RE.match(time))
+            hour, minute = map(int, match.groups()) if match else (99, 99)
+            if hour > 23 or minute > 59:
+                raise ValidationError(
+                    "Time {!r} is not a time like 'HH:MM'".format(time))
+            parsed.append(((day - 1) * MINUTES_PER_DAY + hour * 60 + minute,
+                           capacity))
+    return parsed
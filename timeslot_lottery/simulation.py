@@ -0,0 +1,165 @@
+"""
+What-if simulation of the lottery, without touching the database
+
+`simulate` allocates a `Snapshot` again and again with different seeds
+and reports how full the slots get and how likely every bidder is to
+win.  `rescale` turns a snapshot into one for a template with another
+number of slots, to see what a change of the template would do.
+"""
+import collections
+import multiprocessing
+import random
+
+from timeslot_lottery import allocation
+
+
+class Simulation(object):
+    """
+    Outcome of many simulated allocations of the same bids
+
+    Attributes:
+      runs                   Number of allocations.
+      open_slots             Number of seats open for allocation.
+      fill_rates             Sorted list of the fill rate of every run.
+      unfilled               Dict from number of unfilled seats to the
+                             fraction of runs that left that many.
+      win_probability        Dict from user id to expected number of
+                             slots won per run.
+      slot_fill_probability  Dict from slot id to the expected number of
+                             seats filled per run.
+    """
+    def __init__(self, runs, open_slots, fill_counts, wins, slot_fills):
+        self.runs = runs
+        self.open_slots = open_slots
+        self.fill_rates = sorted(float(filled) / open_slots if open_slots
+                                 else 0.0 for filled in fill_counts)
+        self.unfilled = dict(
+            (unfilled, float(count) / runs) for unfilled, count
+            in collections.Counter(open_slots - filled
+                                   for filled in fill_counts).items())
+        self.win_probability = dict(
+            (user_id, float(count) / runs) for user_id, count in wins.items())
+        self.slot_fill_probability = dict(
+            (slot_id, float(count) / runs)
+            for slot_id, count in slot_fills.items())
+
+    def summary(self):
+        """
+        The distributions as plain data, fit for JSON
+        """
+        rates = self.fill_rates
+        return {
+            'runs': self.runs,
+            'open_slots': self.open_slots,
+            'fill_rate': {
+                'mean': sum(rates) / len(rates) if rates else None,
+                'min': _percentile(rates, 0),
+                'p5': _percentile(rates, 5),
+                'p50': _percentile(rates, 50),
+                'p95': _percentile(rates, 95),
+                'max': _percentile(rates, 100),
+            },
+            'unfilled_slots': sorted(self.unfilled.items()),
+            'win_probability': sorted(self.win_probability.items()),
+            'slot_fill_probability': sorted(
+                self.slot_fill_probability.items()),
+        }
+
+
+def simulate(snapshot, runs=1000, seed=0, workers=1):
+    """
+    Allocate the snapshot `runs` times with different random seeds
+
+    The seeds are drawn from `seed`, so a simulation can be repeated.
+    With more than one worker the runs are split over a process pool.
+
+    Returns:
+      A `Simulation`.
+    """
+    rng = random.Random(seed)
+    seeds = [rng.randint(0, 2 ** 31 - 1) for _ in range(runs)]
+    data = snapshot.to_json()
+    chunks = [(data, seeds[i::workers]) for i in range(workers)]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            parts = pool.map(_run, chunks)
+        finally:
+            pool.terminate()
+    else:
+        parts = [_run(chunk) for chunk in chunks]
+    fill_counts = []
+    wins = collections.Counter()
+    slot_fills = collections.Counter()
+    for part_fill_counts, part_wins, part_slot_fills in parts:
+        fill_counts.extend(part_fill_counts)
+        wins.update(part_wins)
+        slot_fills.update(part_slot_fills)
+    return Simulation(runs, snapshot.open_seats, fill_counts,
+                      wins, slot_fills)
+
+
+def rescale(snapshot, slot_count, capacity=1):
+    """
+    The snapshot as if the week had `slot_count` slots
+
+    The slots are spread evenly over the old ones in time order, and a
+    bid for an old slot becomes a bid for the new slots it overlaps.
+    The new slots have ids 1 to `slot_count`, are all open and have
+    `capacity` seats each.
+    """
+    old_count = len(snapshot.slot_ids)
+    old_index = dict((pk, i) for i, pk in enumerate(snapshot.slot_ids))
+    bids = set()
+    for slot_id, user_id in snapshot.bids:
+        i = old_index.get(slot_id)
+        if i is None:
+            continue
+        start = i * slot_count // old_count
+        end = -(-(i + 1) * slot_count // old_count)
+        for j in range(start, end):
+            bids.add((j + 1, user_id))
+    slot_ids = list(range(1, slot_count + 1))
+    return allocation.Snapshot(slot_ids, slot_ids, sorted(bids),
+                               snapshot.win_counts, snapshot.seed,
+                               snapshot.strategy,
+                               dict((pk, capacity) for pk in slot_ids))
+
+
+def _run(args):
+    """
+    Allocate a snapshot once for every seed
+
+    The bid graph is built once and only the pick order changes between
+    runs.  Module level, so it can run in a process pool.
+    """
+    data, seeds = args
+    snapshot = allocation.Snapshot.from_json(data)
+    graph = allocation.BidGraph(snapshot.slot_ids, snapshot.bids,
+                                snapshot.capacities)
+    open_ids = set(snapshot.open_slot_ids)
+    open_slots = [i for i, slot_id in enumerate(graph.slot_ids)
+                  if slot_id in open_ids]
+    fill_counts = []
+    wins = collections.Counter()
+    slot_fills = collections.Counter()
+    for seed in seeds:
+        order = [graph.bidder_index[bidder_id]
+                 for bidder_id in allocation.pick_order(
+                     graph.bidder_ids, snapshot.win_counts,
+                     random.Random(seed))]
+        won = allocation.allocate(snapshot.strategy, graph, open_slots,
+                                  order)
+        fill_counts.append(len(won))
+        for slot, bidder in won:
+            wins[graph.bidder_ids[bidder]] += 1
+            slot_fills[graph.slot_ids[slot]] += 1
+    return fill_counts, wins, slot_fills
+
+
+def _percentile(values, percent):
+    "Nearest-rank percentile of sorted values"
+    if not values:
+        return None
+    rank = -(-percent * len(values) // 100)
+    return values[max(rank - 1, 0)]
@@ -1,13 +1,50 @@
 import datetime
+import json
+import os
+import random
+import shutil
+import smtplib
+import tempfile
 
+from django.contrib import admin
 from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.http import Http404
+from django.test import RequestFactory
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
 from django.utils import timezone
+from django.utils.six import StringIO
 
+from timeslot_lottery import admin as lottery_admin
+from timeslot_lottery import allocation
+from timeslot_lottery import bench
+from timeslot_lottery import caching
+from timeslot_lottery import export
+from timeslot_lottery import instrumentation
+from timeslot_lottery import models as lottery_models
+from timeslot_lottery import notifications
+from timeslot_lottery import routers
+from timeslot_lottery import simulation
+from timeslot_lottery import utils
 from timeslot_lottery import views
+from timeslot_lottery.models import BidMask
+from timeslot_lottery.models import CloseResult
+from timeslot_lottery.models import PendingBid
 from timeslot_lottery.models import Slot
 from timeslot_lottery.models import Template
 from timeslot_lottery.models import Week
+from timeslot_lottery.models import WinCount
+from timeslot_lottery.models import decode_mask
+from timeslot_lottery.models import encode_mask
 
 
 User = get_user_model()
@@ -33,6 +70,50 @@ class TestBasics(TestCase):
                           'Slot 2010-01-09 23:59:00',
                           'Slot 2010-01-10 00:00:00'])
 
+    def test_template_create_new_week_across_months(self):
+        tmpl = Template.objects.create(
+            slug='test', slots={'1': ['10:00'], '7': ['12:00']})
+        tmpl = Template.objects.get(pk=tmpl.pk)
+        week = tmpl.create_new_week((2014, 5))
+        self.assertEqual([unicode(s) for s in week.slots.all()],
+                         ['Slot 2014-01-27 10:00:00',
+                          'Slot 2014-02-02 12:00:00'])
+
+    def test_create_weeks(self):
+        slots = {1: ['10:00'], 3: ['12:00', '14:00']}
+        tmpl1 = Template.objects.create(slug='one', slots=slots)
+        tmpl2 = Template.objects.create(slug='two', slots=slots)
+        tmpl1.create_new_week((2014, 2))
+
+        with CaptureQueriesContext(connection) as few:
+            Template.objects.create_weeks([(2014, 1)], [tmpl1])
+        with CaptureQueriesContext(connection) as many:
+            weeks = Template.objects.create_weeks(
+                [(2014, 2), (2014, 3), (2014, 4)], [tmpl1, tmpl2])
+
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(5, len(weeks))
+        self.assertEqual(7, Week.objects.all().count())
+        self.assertEqual(21, Slot.objects.all().count())
+        self.assertEqual(3, Week.objects.get(
+            template=tmpl2, year=2014, week_no=4).slots.count())
+
+    def test_create_weeks_for_many_templates(self):
+        # More templates than SQLite allows parameters in one query
+        Template.objects.bulk_create([
+            Template(slug='t{}'.format(i), slots={1: ['10:00']})
+            for i in range(1001)])
+
+        with CaptureQueriesContext(connection) as queries:
+            weeks = Template.objects.create_weeks([(2014, 1)])
+
+        # Existing and new weeks are each looked up in three chunks
+        self.assertEqual(6, len([q for q in queries.captured_queries
+                                 if '"template_id" IN' in q['sql']]))
+        self.assertEqual(1001, len(weeks))
+        self.assertEqual(1001, Slot.objects.count())
+        self.assertEqual([], Template.objects.create_weeks([(2014, 1)]))
+
 
 class TestTemplate(TestCase):
     def test_dates(self):
@@ -53,6 +134,34 @@ class TestTemplate(TestCase):
                          dt(2014, 1, 16, 11, 30))
         self.assertEqual(t.concrete_closing_time(2014, 3).isoweekday(), 4)
 
+    def test_schedule(self):
+        t = Template(title='', slug='',
+                     slots={'7': ['12:00', '00:00'], '1': ['10:00']})
+        self.assertEqual([10 * 60, 6 * 1440, 6 * 1440 + 12 * 60],
+                         list(t.schedule.offsets))
+        self.assertEqual(
+            [('Monday', [datetime.time(10)]),
+             ('Sunday', [datetime.time(0), datetime.time(12)])],
+            t.schedule.days)
+        self.assertIs(t.schedule, Template(slots=t.slots).schedule)
+
+    def test_schedule_capacity(self):
+        t = Template(title='', slug='',
+                     slots={1: ['10:00', ['12:00', 3]]})
+        self.assertEqual([10 * 60, 12 * 60], list(t.schedule.offsets))
+        self.assertEqual([1, 3], list(t.schedule.capacities))
+
+    def test_invalid_slots(self):
+        for slots in [{8: ['10:00']}, {1: ['24:00']}, {1: '10:00'},
+                      {'x': []}, {1: ['10.00']}, {1: [['10:00', 0]]},
+                      {1: [['10:00', 'x']]}, {1: [['10:00', 32768]]}]:
+            t = Template(title='', slug='test', slots=slots)
+            with self.assertRaises(ValidationError):
+                t.save()
+            with self.assertRaises(ValidationError):
+                t.full_clean()
+        self.assertFalse(Template.objects.exists())
+
     def test_far_ahead_dates(self):
         dt = datetime.datetime
         open_dt = dt(2010, 1, 7, 10, 0)
@@ -72,6 +181,167 @@ class TestTemplate(TestCase):
         self.assertEqual(t.concrete_closing_time(2014, 3).isoweekday(), 4)
 
 
+class TestTemplateDetail(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmpl = Template.objects.create(
+            title='Test', slug='test', slots={1: ['10:00']})
+        self.user = User.objects.create(username='user_1')
+
+    def get(self, **params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return views.template_detail(request, 'test')
+
+    def test_current_week_is_memoised(self):
+        week = self.tmpl.create_new_week((2014, 3))
+        tmpl = Template.objects.get(pk=self.tmpl.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(week, tmpl.current_week((2014, 3)))
+            self.assertEqual(week, tmpl.current_week((2014, 3)))
+        with self.assertNumQueries(1):
+            self.assertEqual(None, tmpl.current_week((2014, 4)))
+            self.assertEqual(None, tmpl.current_week((2014, 4)))
+
+    def test_weeks_before(self):
+        Template.objects.create_weeks(
+            [(2013, 52), (2014, 1), (2014, 2), (2014, 3)], [self.tmpl])
+        self.assertEqual(
+            ['2014-3', '2014-2', '2014-1'],
+            [unicode(w) for w in self.tmpl.weeks_before(count=3)])
+        self.assertEqual(
+            ['2014-1', '2013-52'],
+            [unicode(w) for w in self.tmpl.weeks_before((2014, 2))])
+
+    def test_cached_until_weeks_change(self):
+        self.tmpl.create_new_week((2014, 1))
+        self.assertContains(self.get(), '2014-1')
+
+        # Only the template is looked up
+        with self.assertNumQueries(1):
+            self.get()
+
+        self.tmpl.create_new_week((2014, 2))
+        self.assertContains(self.get(), '2014-2')
+
+    def test_pagination(self):
+        Template.objects.create_weeks(
+            [(2014, n) for n in range(1, views.WEEKS_PER_PAGE + 3)],
+            [self.tmpl])
+
+        response = self.get()
+
+        self.assertContains(response, '?before=2014-03')
+        self.assertNotContains(response, ' 2014-2\n')
+        self.assertContains(self.get(before='2014-03'), ' 2014-2\n')
+        self.assertEqual(404, self.get_status(before='bad'))
+
+    def get_status(self, **params):
+        try:
+            return self.get(**params).status_code
+        except Http404:
+            return 404
+
+
+class TestHome(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='user_1')
+        self.other = User.objects.create(username='user_2')
+        self.year_week = timezone.now().isocalendar()[:2]
+        year, week_no = self.year_week
+        self.templates = [
+            Template.objects.create(title='T{}'.format(i),
+                                    slug='t{}'.format(i),
+                                    slots={1: ['10:00', '12:00']})
+            for i in range(3)]
+        self.weeks = [template.create_new_week(self.year_week)
+                      for template in self.templates]
+        # Past weeks aren't shown
+        self.templates[0].create_new_week((year - 1, 1))
+
+    def get(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        return views.home(request)
+
+    def test_for_user(self):
+        w1, w2, w3 = self.weeks
+        s1, s2 = w1.slots.all()
+        w1.set_bids(self.user, [s1.pk, s2.pk])
+        w2.set_bids(self.other, [w2.slots.all()[0].pk])
+        PendingBid.objects.submit(w3, self.user, [w3.slots.all()[1].pk])
+        s2.winner = self.user
+        s2.save()
+
+        with self.assertNumQueries(5):
+            weeks = Week.objects.for_user(self.user, self.year_week)
+
+        self.assertEqual(self.weeks, weeks)
+        self.assertEqual([[s1.time, s2.time], [], [s2.time]],
+                         [w.user_bids for w in weeks])
+        self.assertEqual([[s2.time], [], []], [w.user_wins for w in weeks])
+        self.assertEqual([False, False, True],
+                         [w.has_pending_bids for w in weeks])
+
+    def test_cached_until_bids_or_close(self):
+        week = self.weeks[0]
+        self.assertContains(self.get(), 'T0')
+        with self.assertNumQueries(0):
+            self.get()
+
+        week.set_bids(self.user, [week.slots.all()[0].pk])
+        self.assertContains(self.get(), 'Your bids')
+
+        week.close()
+        self.assertContains(self.get(), 'You won')
+        with self.assertNumQueries(0):
+            self.get()
+
+
+class TestIsoCalendar(SimpleTestCase):
+    def test_round_trip_random_dates(self):
+        rng = random.Random(13)
+        start = datetime.date(1900, 1, 1).toordinal()
+        end = datetime.date(2200, 1, 1).toordinal()
+        for _ in range(5000):
+            date = datetime.date.fromordinal(rng.randint(start, end))
+            self.assertEqual(date, utils.iso_to_gregorian(*date.isocalendar()))
+
+    def test_year_boundaries(self):
+        for year in range(1990, 2041):
+            for day in range(-10, 11):
+                date = datetime.date(year, 1, 1) + datetime.timedelta(day)
+                iso = date.isocalendar()
+                self.assertEqual(date, utils.iso_to_gregorian(*iso))
+                self.assertEqual([date - datetime.timedelta(iso[2] - 1)],
+                                 utils.iso_weeks_to_gregorian([iso[:2]]))
+            last_week = (datetime.date(year, 12, 28).isocalendar()[1])
+            self.assertEqual(last_week, utils.iso_weeks_in_year(year))
+
+    def test_53_week_years(self):
+        self.assertEqual(53, utils.iso_weeks_in_year(2015))
+        self.assertEqual(52, utils.iso_weeks_in_year(2014))
+        self.assertEqual(datetime.date(2016, 1, 3),
+                         utils.iso_to_gregorian(2015, 53, 7))
+        with self.assertRaises(ValueError):
+            utils.iso_to_gregorian(2014, 53, 1)
+        with self.assertRaises(ValueError):
+            utils.iso_to_gregorian(2014, 1, 8)
+
+    def test_concrete_times(self):
+        dt = datetime.datetime
+        t1 = Template(title='', slug='', auto_opening=dt(2014, 1, 7, 10),
+                      auto_closing=dt(2014, 1, 9, 11, 30))
+        t2 = Template(title='', slug='')
+        self.assertEqual(
+            [(dt(2014, 1, 14, 10), dt(2014, 1, 16, 11, 30)),
+             (dt(2015, 12, 29, 10), dt(2015, 12, 31, 11, 30)),
+             (None, None)],
+            Template.objects.concrete_times(
+                [(t1, 2014, 3), (t1, 2015, 53), (t2, 2014, 3)]))
+
+
 class TestCloseAndFillSlots(TestCase):
     def setUp(self):
         tmpl = Template.objects.create(
@@ -122,12 +392,14 @@ class TestCloseAndFillSlots(TestCase):
         s2.bidders.add(u1, u2, u3, u4)
         s3.bidders.add(u1, u2, u3, u4)
 
-        self.week.fill_slots()
+        won_slots, remaining_bidders = self.week.fill_slots()
 
         # One that didn't win
-        self.assertEqual(
-            1, len(set(self.users + [u4]) -
-                   set(s.winner for s in Slot.objects.all())))
+        losers = (set(self.users + [u4]) -
+                  set(s.winner for s in Slot.objects.all()))
+        self.assertEqual(1, len(losers))
+        self.assertEqual(list(losers), remaining_bidders)
+        self.assertEqual(3, len(won_slots))
 
     def test_one_too_few_bidders(self):
         s1, s2, s3 = self.slots
@@ -177,6 +449,137 @@ class TestCloseAndFillSlots(TestCase):
         self.assertEqual(u4, s2.winner)
         self.assertEqual(u5, s3.winner)
 
+    def test_matching_fills_more_slots(self):
+        s1, s2, s3 = self.slots
+        u1, u2, u3 = self.users
+
+        # u1 picks first, then u2, then u3
+        week2 = Week.objects.create(year=2000, week_no=1,
+                                    template=self.week.template)
+        Slot.objects.create(
+            week=week2, time=timezone.now(), winner=u2)
+        Slot.objects.create(
+            week=week2, time=timezone.now(), winner=u3)
+        Slot.objects.create(
+            week=week2, time=timezone.now(), winner=u3)
+
+        s1.bidders.add(u1, u2)
+        s2.bidders.add(u1, u3)
+        s3.bidders.add(u3)
+
+        won_slots, remaining_bidders = self.week.fill_slots(
+            strategy=allocation.MATCHING)
+
+        # Greedy would give u1 Slot 1 and leave Slot 2 empty
+        s1, s2, s3 = self.week.slots.all()
+        self.assertEqual(u2, s1.winner)
+        self.assertEqual(u1, s2.winner)
+        self.assertEqual(u3, s3.winner)
+        self.assertEqual([], remaining_bidders)
+
+    def test_flow_fills_seats(self):
+        s1, s2, s3 = self.slots
+        u1, u2, u3 = self.users
+        Slot.objects.filter(pk=s1.pk).update(capacity=2)
+        s1.bidders.add(u1, u2, u3)
+        s2.bidders.add(u1)
+
+        won_slots, remaining_bidders = self.week.fill_slots(
+            strategy=allocation.FLOW)
+
+        self.assertEqual(3, len(won_slots))
+        self.assertEqual([], remaining_bidders)
+        s1, s2, s3 = self.week.slots.all()
+        self.assertEqual(set([u2, u3]), set(s1.winners.all()))
+        self.assertIn(s1.winner, [u2, u3])
+        self.assertEqual([u1], list(s2.winners.all()))
+        self.assertEqual({u1.pk: 1, u2.pk: 1, u3.pk: 1},
+                         WinCount.objects.totals([u1.pk, u2.pk, u3.pk]))
+        # Full slots are left out of the next allocation
+        self.assertEqual([s3.pk], self.week.snapshot().open_slot_ids)
+
+    def test_close_is_stored(self):
+        s1, s2, s3 = self.slots
+        u1, u2, u3 = self.users
+        s1.bidders.add(u1, u2)
+
+        won_slots, remaining_bidders = self.week.close()
+
+        week = Week.objects.get(pk=self.week.pk)
+        self.assertEqual(Week.STATUS.closed, week.status)
+        self.assertEqual([[s1.pk, won_slots[0].winner.pk]],
+                         week.close_result.allocation)
+        self.assertEqual([b.pk for b in remaining_bidders],
+                         week.close_result.remaining_bidders)
+
+        # Closing again returns the stored result
+        s2.bidders.add(u3)
+        self.assertEqual((won_slots, remaining_bidders), week.close())
+        self.assertEqual(None, Slot.objects.get(pk=s2.pk).winner)
+
+    def test_close_is_reproducible(self):
+        s1, s2, s3 = self.slots
+        u1, u2, u3 = self.users
+        s1.bidders.add(u1, u2, u3)
+        s2.bidders.add(u1, u2, u3)
+        snapshot = self.week.snapshot()
+
+        self.week.close()
+
+        result = Week.objects.get(pk=self.week.pk).close_result
+        self.assertEqual(self.week.seed, result.seed)
+        self.assertTrue(result.verify())
+        won, remaining_ids = snapshot.allocate()
+        self.assertEqual(
+            (result.allocation, result.remaining_bidders),
+            ([list(pair) for pair in won], remaining_ids))
+        out = StringIO()
+        call_command('replay_closes', stdout=out)
+        self.assertIn('1 verified', out.getvalue())
+
+        # Tampering with the stored result is noticed
+        result.allocation = result.allocation[::-1]
+        self.assertFalse(result.verify())
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            self.week.fill_slots(strategy='nonsense')
+
+    def test_simulate_command_saves_nothing(self):
+        s1, s2, s3 = self.slots
+        s1.bidders.add(*self.users)
+        out = StringIO()
+
+        call_command('simulate_lottery', 'test', '2010-01', runs=20,
+                     slots=6, stdout=out)
+
+        summary = json.loads(out.getvalue())
+        self.assertEqual((20, 6), (summary['runs'], summary['open_slots']))
+        # s1 becomes the first two of six slots
+        self.assertAlmostEqual(
+            2.0, sum(p for _, p in summary['win_probability']))
+        self.assertFalse(Slot.objects.filter(winner__isnull=False).exists())
+        self.assertEqual(Week.STATUS.new, Week.objects.get().status)
+
+    def test_simulate_command_leaves_pending_bids(self):
+        s1, s2, s3 = self.slots
+        u1, u2, u3 = self.users
+        s1.bidders.add(u1)
+        PendingBid.objects.submit(self.week, u1, [s2.pk])
+        PendingBid.objects.submit(self.week, u2, [s3.pk])
+        out = StringIO()
+
+        call_command('simulate_lottery', 'test', '2010-01', runs=5,
+                     stdout=out)
+
+        summary = json.loads(out.getvalue())
+        self.assertEqual(
+            [[u1.pk, 1.0], [u2.pk, 1.0]],
+            sorted(summary['win_probability']))
+        self.assertEqual(2, PendingBid.objects.count())
+        self.assertEqual([u1], list(s1.bidders.all()))
+        self.assertFalse(s2.bidders.exists() or s3.bidders.exists())
+
     def test_lower_pri_nonpicky_may_win(self):
         s1, s2, s3 = self.slots
         u1, u2, u3 = self.users
@@ -205,6 +608,978 @@ class TestCloseAndFillSlots(TestCase):
         self.assertEqual(u2, s3.winner)
 
 
+class TestBids(TestCase):
+    def setUp(self):
+        tmpl = Template.objects.create(
+            slug='test',
+            slots={1:['10:00'], 7:['00:00', '12:00']})
+        self.week = tmpl.create_new_week((2010, 1))
+        self.slots = self.week.slots.all()
+        self.user = User.objects.create(username='user_1')
+
+    def test_set_bids(self):
+        s1, s2, s3 = self.slots
+        other_week = self.week.template.create_new_week((2010, 2))
+        other_slot = other_week.slots.all()[0]
+        s1.bidders.add(self.user)
+
+        self.week.set_bids(self.user, [s2.pk, s3.pk, other_slot.pk])
+
+        self.assertEqual(set([s2, s3]), set(self.user.slots_bid_for.all()))
+
+        self.week.set_bids(self.user, [])
+
+        self.assertFalse(self.user.slots_bid_for.exists())
+
+    def test_set_bids_writes_only_the_difference(self):
+        s1, s2, s3 = self.slots
+        self.week.set_bids(self.user, [s1.pk, s2.pk])
+        with CaptureQueriesContext(connection) as unchanged:
+            self.week.set_bids(self.user, [s1.pk, s2.pk])
+        with CaptureQueriesContext(connection) as changed:
+            self.week.set_bids(self.user, [s2.pk, s3.pk])
+
+        self.assertFalse([q for q in unchanged.captured_queries
+                          if 'INSERT' in q['sql'] or 'DELETE' in q['sql']])
+        # One bulk delete and one bulk insert
+        self.assertEqual(len(unchanged) + 2, len(changed))
+
+    def test_week_detail_post(self):
+        s1, s2, s3 = self.slots
+        request = RequestFactory().post('/', {
+            'slot-{}'.format(s1.pk): 'on',
+            'slot-{}'.format(s3.pk): 'on',
+        })
+        request.user = self.user
+
+        response = views.week_detail(request, 'test', '2010', '01')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(set([s1, s3]), set(self.user.slots_bid_for.all()))
+
+    def test_week_detail_staff_creates_only_real_weeks(self):
+        request = RequestFactory().get('/')
+        request.user = User.objects.create(username='staff', is_staff=True)
+
+        for week_no in ['53', '00']:
+            with self.assertRaises(Http404):
+                views.week_detail(request, 'test', '2014', week_no)
+        self.assertFalse(Week.objects.filter(year=2014).exists())
+        self.assertEqual(
+            200, views.week_detail(request, 'test', '2015', '53').status_code)
+
+
+class TestPendingBids(TestCase):
+    def setUp(self):
+        tmpl = Template.objects.create(
+            slug='test',
+            slots={1:['10:00'], 7:['00:00', '12:00']})
+        self.week = tmpl.create_new_week((2010, 1))
+        self.slots = self.week.slots.all()
+        self.user = User.objects.create(username='user_1')
+
+    def request(self, data=None):
+        factory = RequestFactory()
+        if data is None:
+            request = factory.get('/')
+        else:
+            request = factory.post('/', json.dumps(data),
+                                   content_type='application/json')
+        request.user = self.user
+        response = views.week_bids(request, 'test', '2010', '01')
+        return response.status_code, json.loads(response.content.decode())
+
+    def test_submit_and_read(self):
+        s1, s2, s3 = self.slots
+        s1.bidders.add(self.user)
+
+        self.assertEqual((200, {'slots': [s1.pk]}), self.request())
+        self.assertEqual((202, {'slots': [s2.pk, s3.pk]}),
+                         self.request({'slots': [s3.pk, s2.pk]}))
+
+        # Buffered, not written yet
+        self.assertEqual([s1], list(self.user.slots_bid_for.all()))
+        self.assertEqual((200, {'slots': [s2.pk, s3.pk]}), self.request())
+
+        self.assertEqual(1, PendingBid.objects.flush())
+        self.assertEqual(set([s2, s3]), set(self.user.slots_bid_for.all()))
+        self.assertFalse(PendingBid.objects.exists())
+
+    def test_invalid_slots(self):
+        other_week = self.week.template.create_new_week((2010, 2))
+        other_slot = other_week.slots.all()[0]
+
+        status, data = self.request({'slots': [other_slot.pk]})
+        self.assertEqual((400, [other_slot.pk]), (status, data['invalid']))
+        self.assertEqual(400, self.request({'slot': []})[0])
+        self.assertEqual(400, self.request({'slots': 'x'})[0])
+        self.assertFalse(PendingBid.objects.exists())
+
+    def test_close_flushes_pending_bids(self):
+        s1, _, _ = self.slots
+        self.request({'slots': [s1.pk]})
+
+        self.week.close()
+
+        self.assertEqual(self.user, Slot.objects.get(pk=s1.pk).winner)
+        self.assertEqual(409, self.request({'slots': [s1.pk]})[0])
+
+    def test_flush_drops_bids_for_closed_weeks(self):
+        s1, _, _ = self.slots
+        PendingBid.objects.submit(self.week, self.user, [s1.pk])
+        self.week.status = Week.STATUS.closed
+        self.week.save()
+
+        self.assertEqual(0, PendingBid.objects.flush())
+        self.assertFalse(PendingBid.objects.exists())
+        self.assertFalse(self.user.slots_bid_for.exists())
+
+    def test_pending_flag_expires(self):
+        self.addCleanup(setattr, lottery_models, 'CACHE_TIMEOUT',
+                        lottery_models.CACHE_TIMEOUT)
+        lottery_models.CACHE_TIMEOUT = 0
+        week = self.week.template.create_new_week((2010, 2))
+        self.assertFalse(week.has_pending())
+
+        # As if submitted by a process that doesn't share this cache
+        PendingBid.objects.create(week=week, user=self.user,
+                                  slot_ids=[week.slots.all()[0].pk])
+
+        self.assertTrue(week.has_pending())
+
+    def test_flush_queries_dont_grow_with_users(self):
+        s1, s2, s3 = self.slots
+        users = [User.objects.create(username='user_{}'.format(i))
+                 for i in range(2, 12)]
+        PendingBid.objects.submit(self.week, self.user, [s1.pk])
+        with CaptureQueriesContext(connection) as one:
+            PendingBid.objects.flush()
+        for user in users:
+            PendingBid.objects.submit(self.week, user, [s2.pk, s3.pk])
+        with CaptureQueriesContext(connection) as many:
+            PendingBid.objects.flush()
+
+        self.assertEqual(len(one), len(many))
+        self.assertEqual(10, s2.bidders.count())
+
+
+@override_settings(TIMESLOT_LOTTERY_BID_STORAGE='bitmask')
+class TestBitmaskBids(TestCase):
+    def setUp(self):
+        cache.clear()
+        tmpl = Template.objects.create(
+            slug='test',
+            slots={1:['10:00'], 7:['00:00', '12:00']})
+        self.week = tmpl.create_new_week((2010, 1))
+        self.slots = list(self.week.slots.all())
+        self.users = [User.objects.create(username='user_{}'.format(i))
+                      for i in range(3)]
+
+    def masks(self):
+        return list(BidMask.objects.values_list('mask', flat=True))
+
+    def test_mask_round_trip(self):
+        order = [5, 3, 9]
+        self.assertEqual('5', encode_mask([9, 5, 42], order))
+        self.assertEqual([5, 9], decode_mask('5', order))
+        self.assertEqual('0', encode_mask([], order))
+
+    def test_set_bids_writes_one_row(self):
+        s1, s2, s3 = self.slots
+        u1 = self.users[0]
+
+        self.week.set_bids(u1, [s1.pk, s3.pk])
+        self.assertEqual(['5'], self.masks())
+        self.assertFalse(u1.slots_bid_for.exists())
+        self.assertEqual(set([s1.pk, s3.pk]), self.week.bid_slot_ids(u1))
+
+        self.week.set_bids(u1, [s2.pk])
+        self.assertEqual(['2'], self.masks())
+        self.week.set_bids(u1, [])
+        self.assertEqual([], self.masks())
+
+    def test_week_page_export_and_allocation(self):
+        s1, s2, s3 = self.slots
+        u1, u2, u3 = self.users
+        self.week.set_bids(u1, [s1.pk])
+        self.week.set_bids(u2, [s1.pk, s2.pk])
+        PendingBid.objects.submit(self.week, u3, [s3.pk])
+        request = RequestFactory().get('/')
+        request.user = u2
+
+        self.assertContains(
+            views.week_detail(request, 'test', '2010', '01'), '2 bids')
+        self.assertEqual(['user_0', 'user_1'],
+                         next(export.rows(self.week.template))['bidders'])
+        won_slots, remaining_bidders = self.week.fill_slots()
+
+        self.assertEqual(3, len(won_slots))
+        self.assertEqual(3, BidMask.objects.count())
+        self.assertFalse(Slot.bidders.through.objects.exists())
+
+    def test_slot_changes_keep_bids(self):
+        s1, s2, s3 = self.slots
+        u1 = self.users[0]
+        self.week.set_bids(u1, [s2.pk, s3.pk])
+
+        # A slot before the others moves their bits up one
+        Slot.objects.create(week=self.week,
+                            time=s1.time - datetime.timedelta(hours=1))
+        self.assertEqual(['c'], self.masks())
+        self.assertEqual(set([s2.pk, s3.pk]), self.week.bid_slot_ids(u1))
+
+        s2.delete()
+        self.assertEqual(set([s3.pk]), self.week.bid_slot_ids(u1))
+
+    def test_queryset_delete_keeps_bids(self):
+        s1, s2, s3 = self.slots
+        u1 = self.users[0]
+        self.week.set_bids(u1, [s1.pk, s3.pk])
+
+        Slot.objects.filter(pk__in=[s1.pk, s2.pk]).delete()
+        cache.clear()
+
+        self.assertEqual(set([s3.pk]), self.week.bid_slot_ids(u1))
+        self.assertEqual(set([s3.pk]), self.week.slot_id_set())
+
+    def test_stale_cached_order_is_noticed(self):
+        s1, s2, s3 = self.slots
+        u1, u2, _ = self.users
+        self.week.set_bids(u1, [s2.pk, s3.pk])
+        # Like the order cached by another process before a slot moved
+        stale_order = [s3.pk, s1.pk, s2.pk]
+        order_key = caching.make_key(self.week.cache_name, 'slot-order')
+        cache.set(order_key, stale_order, None)
+
+        self.assertEqual(set([s2.pk, s3.pk]), self.week.bid_slot_ids(u1))
+        cache.set(order_key, stale_order, None)
+        self.week.set_bids(u2, [s1.pk])
+        cache.set(order_key, stale_order, None)
+        self.assertEqual(set([(s2.pk, u1.pk), (s3.pk, u1.pk), (s1.pk, u2.pk)]),
+                         set(self.week.bid_pairs()))
+
+    @override_settings(TIMESLOT_LOTTERY_BID_STORAGE='m2m')
+    def test_slot_changes_skip_masks_with_m2m_storage(self):
+        s1, s2, s3 = self.slots
+        s1.time -= datetime.timedelta(hours=1)
+        with CaptureQueriesContext(connection) as queries:
+            s1.save()
+            s2.delete()
+
+        self.assertFalse([q for q in queries.captured_queries
+                          if 'bidmask' in q['sql'].lower()])
+
+    def test_convert_bids(self):
+        s1, s2, s3 = self.slots
+        u1, u2, _ = self.users
+        s1.bidders.add(u1, u2)
+        s3.bidders.add(u1)
+
+        call_command('convert_bids', stdout=StringIO())
+        self.assertFalse(Slot.bidders.through.objects.exists())
+        self.assertEqual(set([s1.pk, s3.pk]), self.week.bid_slot_ids(u1))
+
+        call_command('convert_bids', to='m2m', stdout=StringIO())
+        self.assertEqual([], self.masks())
+        self.assertEqual(set([u1, u2]), set(s1.bidders.all()))
+
+
+class TestWeekDetailQueries(TestCase):
+    def assert_week_detail_queries(self, num_slots):
+        times = ['{:02d}:{:02d}'.format(*divmod(minute, 60))
+                 for minute in range(num_slots)]
+        tmpl = Template.objects.create(slug='q{}'.format(num_slots),
+                                       slots={1: times})
+        week = tmpl.create_new_week((2010, 1))
+        user = User.objects.create(username='user_{}'.format(num_slots))
+        other = User.objects.create(username='other_{}'.format(num_slots))
+        slots = list(week.slots.all())
+        week.set_bids(user, [slot.pk for slot in slots[::2]])
+        week.set_bids(other, [slot.pk for slot in slots[::3]])
+        Slot.objects.filter(pk=slots[0].pk).update(winner=other)
+        request = RequestFactory().get('/')
+        request.user = user
+
+        # The week, its slots, their winners and the user's bids
+        with self.assertNumQueries(4):
+            response = views.week_detail(request, tmpl.slug, '2010', '01')
+
+        self.assertEqual(200, response.status_code)
+
+    def test_10_slots(self):
+        self.assert_week_detail_queries(10)
+
+    def test_100_slots(self):
+        self.assert_week_detail_queries(100)
+
+    def test_1000_slots(self):
+        self.assert_week_detail_queries(1000)
+
+
+class TestClosedWeek(TestCase):
+    def setUp(self):
+        self.tmpl = Template.objects.create(
+            slug='test', slots={1: ['10:00', '12:00']})
+        self.week = self.tmpl.create_new_week((2010, 1))
+        self.user = User.objects.create(username='user_1')
+        self.other = User.objects.create(username='user_2')
+        s1, s2 = self.slots = list(self.week.slots.all())
+        s1.bidders.add(self.user)
+        s2.bidders.add(self.user, self.other)
+        self.week.close()
+
+    def get(self, view, user=None, **headers):
+        request = RequestFactory().get('/', **headers)
+        request.user = user or self.user
+        return view(request, 'test', '2010', '01')
+
+    def test_close_stores_results(self):
+        s1, s2 = self.slots
+        results = CloseResult.objects.get(week=self.week).results
+        self.assertEqual([s1.pk, s2.pk],
+                         [slot['id'] for slot in results['slots']])
+        self.assertEqual([[self.user.pk], [self.user.pk, self.other.pk]],
+                         [slot['bidders'] for slot in results['slots']])
+        self.assertEqual([[[self.user.pk, 'user_1']],
+                          [[self.other.pk, 'user_2']]],
+                         [slot['winners'] for slot in results['slots']])
+
+    def test_week_detail_from_results(self):
+        with self.assertNumQueries(1):
+            response = self.get(views.week_detail)
+
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, 'user_2')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotEqual(
+            response['ETag'],
+            self.get(views.week_detail, self.other)['ETag'])
+
+    def test_week_detail_rejects_bids(self):
+        s1, s2 = self.slots
+        request = RequestFactory().post('/', {'slot-{}'.format(s1.pk): 'on'})
+        request.user = self.other
+
+        response = views.week_detail(request, 'test', '2010', '01')
+
+        self.assertEqual(409, response.status_code)
+        self.assertEqual([self.user], list(s1.bidders.all()))
+        self.assertFalse(PendingBid.objects.exists())
+
+    def test_conditional_get(self):
+        response = self.get(views.week_detail)
+
+        with self.assertNumQueries(1):
+            not_modified = self.get(views.week_detail,
+                                    HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, not_modified.status_code)
+        self.assertEqual(response['ETag'], not_modified['ETag'])
+        self.assertEqual(304, self.get(
+            views.week_detail,
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code)
+        self.assertEqual(200, self.get(
+            views.week_detail, HTTP_IF_NONE_MATCH='"other"').status_code)
+
+    def test_week_bids_and_results(self):
+        s1, s2 = self.slots
+        response = self.get(views.week_bids, self.other)
+        self.assertEqual({'slots': [s2.pk]},
+                         json.loads(response.content.decode('utf-8')))
+
+        with self.assertNumQueries(1):
+            response = self.get(views.week_results)
+        results = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([1, 2], [slot['num_bids']
+                                  for slot in results['slots']])
+        self.assertEqual(set(['user_1', 'user_2']), set(
+            name for slot in results['slots'] for name in slot['winners']))
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_results_stored_for_older_closes(self):
+        CloseResult.objects.filter(week=self.week).update(results=None)
+        self.assertEqual(200, self.get(views.week_detail).status_code)
+        self.assertIsNotNone(CloseResult.objects.get(week=self.week).results)
+
+    def test_open_week_has_no_results(self):
+        self.tmpl.create_new_week((2010, 2))
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with self.assertRaises(Http404):
+            views.week_results(request, 'test', '2010', '02')
+
+
+class TestAllocation(SimpleTestCase):
+    def test_bid_graph(self):
+        graph = allocation.BidGraph(
+            [10, 20, 30], [(10, 5), (20, 5), (20, 7), (99, 7)])
+        self.assertEqual([5, 7], graph.bidder_ids)
+        self.assertEqual([set([0]), set([0, 1]), set()],
+                         graph.slot_bidders)
+        self.assertEqual([set([0, 1]), set([1])], graph.bidder_slots)
+
+    def test_greedy_least_wanted_slot_first(self):
+        graph = allocation.BidGraph(
+            [1, 2, 3], [(1, 1), (1, 2), (2, 1), (2, 2), (3, 1)])
+        self.assertEqual([(2, 0), (0, 1)],
+                         allocation.greedy(graph, [0, 1, 2], [0, 1]))
+        # Only open slots are handed out
+        self.assertEqual([(0, 0), (1, 1)],
+                         allocation.greedy(graph, [0, 1], [0, 1]))
+
+    def test_pick_order(self):
+        order = allocation.pick_order(
+            [4, 3, 2, 1], {1: 2, 2: 1, 3: 1}, random.Random(1))
+        self.assertEqual(4, order[0])
+        self.assertEqual(set([2, 3]), set(order[1:3]))
+        self.assertEqual(1, order[3])
+        self.assertEqual(order, allocation.pick_order(
+            [1, 2, 3, 4], {1: 2, 2: 1, 3: 1}, random.Random(1)))
+
+    def test_pick_order_is_the_same_on_every_python(self):
+        # What random.shuffle gave on Python 2, where closes were stored
+        self.assertEqual([10, 8, 9, 6, 4, 5, 2, 3, 1, 7],
+                         allocation.pick_order(range(1, 11), {},
+                                               random.Random(42)))
+
+    def test_snapshot_json_round_trip(self):
+        snapshot = allocation.Snapshot(
+            [1, 2, 3], [1, 3], [(1, 10), (1, 11), (3, 11), (2, 12)],
+            {10: 1}, seed=42, strategy=allocation.MATCHING)
+        copy = allocation.Snapshot.from_json(
+            json.loads(json.dumps(snapshot.to_json())))
+        self.assertEqual(snapshot.allocate(), copy.allocate())
+        # 12 only bid for a slot that's already taken
+        self.assertEqual(([(3, 11), (1, 10)], [12]), snapshot.allocate())
+
+    def test_priority_matching_moves_earlier_bidders(self):
+        graph = allocation.BidGraph(
+            [1, 2, 3], [(1, 1), (1, 2), (2, 1), (2, 3), (3, 3)])
+        self.assertEqual([(0, 0)],
+                         allocation.greedy(graph, [0, 1, 2], [0, 1])[:1])
+        self.assertEqual([(1, 0), (0, 1), (2, 2)],
+                         allocation.priority_matching(
+                             graph, [0, 1, 2], [0, 1, 2]))
+
+    def test_priority_matching_prefers_early_bidders(self):
+        # Only one of the last two can get a slot
+        graph = allocation.BidGraph(
+            [1, 2], [(1, 1), (2, 1), (2, 2), (2, 3)])
+        self.assertEqual([(0, 0), (1, 2)],
+                         allocation.priority_matching(
+                             graph, [0, 1], [0, 2, 1]))
+
+
+    def test_priority_flow_fills_capacity(self):
+        # Slot 1 has two seats, bidder 0 moves to slot 2 to make room
+        graph = allocation.BidGraph(
+            [1, 2], [(1, 1), (2, 1), (1, 2), (1, 3)], {1: 2})
+        self.assertEqual([2, 1], graph.capacities)
+        self.assertEqual([(1, 0), (0, 1), (0, 2)],
+                         allocation.priority_flow(graph, [0, 1], [0, 1, 2]))
+
+
+class TestSimulation(SimpleTestCase):
+    def setUp(self):
+        self.snapshot = allocation.Snapshot(
+            slot_ids=[10, 20, 30], open_slot_ids=[10, 20, 30],
+            bids=[(10, 1), (10, 2), (20, 2), (30, 3), (30, 4)],
+            win_counts={1: 2}, seed=5)
+
+    def test_simulate(self):
+        result = simulation.simulate(self.snapshot, runs=200, seed=1)
+
+        self.assertEqual(200, len(result.fill_rates))
+        self.assertEqual({0: 1.0}, result.unfilled)
+        # 3 and 4 share a slot, and have the same number of wins
+        probability = result.win_probability
+        self.assertEqual((1.0, 1.0), (probability[1], probability[2]))
+        self.assertAlmostEqual(1.0, probability[3] + probability[4])
+        self.assertTrue(0.3 < probability[3] < 0.7)
+        self.assertEqual(result.summary(),
+                         simulation.simulate(self.snapshot, runs=200,
+                                             seed=1).summary())
+
+    def test_simulate_does_not_change_the_snapshot(self):
+        before = self.snapshot.to_json()
+        simulation.simulate(self.snapshot, runs=10)
+        self.assertEqual(before, self.snapshot.to_json())
+
+    def test_rescale(self):
+        fewer = simulation.rescale(self.snapshot, 2)
+        self.assertEqual([1, 2], fewer.open_slot_ids)
+        self.assertEqual([(1, 1), (1, 2), (2, 2), (2, 3), (2, 4)],
+                         fewer.bids)
+        summary = simulation.simulate(fewer, runs=50).summary()
+        self.assertEqual(1.0, summary['fill_rate']['p50'])
+        self.assertEqual(6, len(simulation.rescale(self.snapshot,
+                                                   6).slot_ids))
+
+
+class TestClosePending(TestCase):
+    def setUp(self):
+        self.tmpl = Template.objects.create(slug='test', slots={1:['10:00']})
+        self.user = User.objects.create(username='user_1')
+
+    def create_week(self, week_no, closes_in_days):
+        week = self.tmpl.create_new_week((2010, week_no))
+        week.auto_close_from = (
+            timezone.now() + datetime.timedelta(days=closes_in_days))
+        week.save()
+        week.slots.get().bidders.add(self.user)
+        return week
+
+    def test_iter_close_pending(self):
+        pending = [self.create_week(1, -2), self.create_week(2, -1)]
+        self.create_week(3, 1)
+        closed = self.create_week(4, -3)
+        closed.status = Week.STATUS.closed
+        closed.save()
+
+        results = list(Week.objects.iter_close_pending(batch_size=1))
+
+        self.assertEqual(pending, [week for week, _, _ in results])
+        self.assertEqual(
+            [1, 1], [len(r['updated_slots']) for _, r, _ in results])
+        self.assertEqual(
+            set([Week.STATUS.closed]),
+            set(Week.objects.filter(pk__in=[w.pk for w in pending])
+                .values_list('status', flat=True)))
+        self.assertFalse(Week.objects.pending().exists())
+
+    def test_command(self):
+        self.create_week(1, -1)
+        out = StringIO()
+
+        call_command('close_pending_weeks', workers=1, stdout=out)
+
+        self.assertIn('2010-01', out.getvalue())
+        self.assertEqual(Week.STATUS.closed, Week.objects.get().status)
+
+    def test_command_metrics(self):
+        self.create_week(1, -2)
+        self.create_week(2, -1)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(instrumentation.aggregator.reset)
+        if instrumentation.aggregator not in instrumentation._callbacks:
+            self.addCleanup(instrumentation.unregister,
+                            instrumentation.aggregator)
+        path = os.path.join(directory, 'metrics.prom')
+
+        call_command('close_pending_weeks', workers=1, metrics_file=path,
+                     stdout=StringIO())
+
+        with open(path) as f:
+            text = f.read()
+        self.assertIn('timeslot_lottery_operation_seconds_count'
+                      '{operation="close_pending"} 1.0\n', text)
+        self.assertIn('timeslot_lottery_weeks_total'
+                      '{operation="close_pending"} 2.0\n', text)
+        self.assertIn('timeslot_lottery_operation_seconds_count'
+                      '{operation="week_close"} 2.0\n', text)
+
+    def test_locked_week_holds_back_its_template(self):
+        first, second = self.create_week(1, -2), self.create_week(2, -1)
+        other = Template.objects.create(slug='other', slots={1: ['10:00']})
+        other_week = other.create_new_week((2010, 1))
+        other_week.auto_close_from = first.auto_close_from
+        other_week.save()
+        close_once = Week.objects._close_once
+
+        def locked_first(week_id):
+            if week_id == first.pk:
+                return False
+            return close_once(week_id)
+        Week.objects._close_once = locked_first
+        self.addCleanup(delattr, Week.objects, '_close_once')
+
+        results = list(Week.objects.iter_close_pending(batch_size=1))
+
+        self.assertEqual([other_week], [week for week, _, _ in results])
+        self.assertEqual(set([first, second]), set(Week.objects.pending()))
+
+
+class TestClosePendingThreads(TransactionTestCase):
+    def setUp(self):
+        if connection.settings_dict['NAME'] == ':memory:':
+            self.skipTest("Threads can't share this in-memory database")
+        # The shared in-memory database fails on locks at once
+        for name, value in [('CLOSE_ATTEMPTS', 20),
+                            ('CLOSE_RETRY_DELAY', 0.02)]:
+            self.addCleanup(setattr, lottery_models, name,
+                            getattr(lottery_models, name))
+            setattr(lottery_models, name, value)
+        self.user = User.objects.create(username='user_1')
+        self.weeks = []
+        for slug in ['one', 'two', 'three']:
+            template = Template.objects.create(slug=slug,
+                                               slots={1: ['10:00']})
+            for week_no in [1, 2, 3]:
+                week = template.create_new_week((2010, week_no))
+                week.auto_close_from = timezone.now() - datetime.timedelta(
+                    days=10 - week_no)
+                week.save()
+                week.slots.get().bidders.add(self.user)
+                self.weeks.append(week)
+
+    def test_templates_in_parallel_weeks_in_order(self):
+        results = list(Week.objects.iter_close_pending(workers=3,
+                                                       batch_size=4))
+
+        self.assertEqual(9, len(results))
+        self.assertFalse(Week.objects.pending().exists())
+        for template in Template.objects.all():
+            closed = list(CloseResult.objects.filter(week__template=template)
+                          .order_by('pk').values_list('week__week_no',
+                                                      flat=True))
+            self.assertEqual([1, 2, 3], closed)
+        self.assertEqual([3, 3, 3], sorted(
+            WinCount.objects.values_list('count', flat=True)))
+
+
+class TestOpenDueWeeks(TestCase):
+    def create_template(self, slug, opening_day):
+        return Template.objects.create(
+            slug=slug, slots={1: ['10:00']},
+            auto_opening=datetime.datetime(2014, 1, 5 + opening_day, 10),
+            auto_closing=datetime.datetime(2014, 1, 12, 10))
+
+    def test_open_due_weeks(self):
+        now = datetime.datetime(2014, 1, 15, 12)  # Wednesday, week 3
+        due = self.create_template('due', 2)
+        self.create_template('later', 4)
+        exists = self.create_template('exists', 1)
+        exists.create_new_week((2014, 3))
+        Template.objects.create(slug='manual', slots={1: ['10:00']})
+
+        self.assertEqual([due], Template.objects.due_for_opening(now))
+        weeks = Template.objects.open_due_weeks(now)
+
+        self.assertEqual([(due, 2014, 3)],
+                         [(w.template, w.year, w.week_no) for w in weeks])
+        self.assertEqual(1, due.weeks.get().slots.count())
+        self.assertEqual([], Template.objects.due_for_opening(now))
+
+    def test_queries_dont_grow_with_templates(self):
+        now = datetime.datetime(2014, 1, 15, 12)
+        self.create_template('first', 1)
+        with CaptureQueriesContext(connection) as one:
+            Template.objects.open_due_weeks(now)
+        for i in range(10):
+            self.create_template('t{}'.format(i), 1)
+        with CaptureQueriesContext(connection) as many:
+            Template.objects.open_due_weeks(now)
+        self.assertEqual(len(one), len(many))
+        self.assertEqual(11, Week.objects.count())
+
+
+class TestBench(TestCase):
+    def test_run_benchmarks(self):
+        results = bench.run_benchmarks(slots=5, users=8, bids_per_user=2,
+                                       distribution='skewed', weeks=2)
+
+        self.assertEqual(list(bench.runner.BENCHMARKS),
+                         [r['name'] for r in results])
+        for result in results:
+            self.assertGreater(result['queries'], 0)
+            self.assertGreaterEqual(result['seconds'], 0)
+        # Everything is rolled back
+        self.assertFalse(Template.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+    def test_command(self):
+        out = StringIO()
+        call_command('lottery_bench', 'fill_slots', slots=3, users=4,
+                     stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(['fill_slots'],
+                         [r['name'] for r in report['results']])
+
+    def test_skewed_bids(self):
+        rng = random.Random(0)
+        picks = [bench.data.pick_slots(range(10), 2, 'skewed', rng)
+                 for _ in range(500)]
+        counts = [sum(slot in p for p in picks) for slot in range(10)]
+        self.assertTrue(all(len(set(p)) == 2 for p in picks))
+        self.assertGreater(counts[0], counts[9] * 2)
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        self.events = []
+        instrumentation.register(self.events.append)
+        self.addCleanup(instrumentation.unregister, self.events.append)
+
+    def test_allocation_event(self):
+        tmpl = Template.objects.create(slug='test', slots={1: ['10:00',
+                                                              '12:00']})
+        week = tmpl.create_new_week((2010, 1))
+        user = User.objects.create(username='user_1')
+        week.slots.all()[0].bidders.add(user)
+        del self.events[:]
+
+        week.fill_slots()
+
+        # Nothing was pending, so there's no bid_flush event
+        event, = self.events
+        self.assertEqual('allocation', event.name)
+        self.assertGreater(event.queries, 0)
+        self.assertEqual({'slots': 2, 'seats': 2, 'bidders': 1, 'filled': 1,
+                          'fill_rate': 0.5}, event.values)
+
+    def test_counts_queries_without_logging_them(self):
+        logged = len(connection.queries)
+        with instrumentation.instrument('outer'):
+            User.objects.count()
+            with instrumentation.instrument('inner'):
+                User.objects.exists()
+
+        self.assertEqual([('inner', 1), ('outer', 2)],
+                         [(e.name, e.queries) for e in self.events])
+        self.assertEqual(logged, len(connection.queries))
+        self.assertNotIn('cursor', connection.__dict__)
+
+    def test_failing_callback_is_ignored(self):
+        def fail(event):
+            raise ValueError("Broken callback")
+        instrumentation.register(fail)
+        self.addCleanup(instrumentation.unregister, fail)
+        with instrumentation.instrument('test', things=2):
+            pass
+        self.assertEqual([('test', {'things': 2})],
+                         [(e.name, e.values) for e in self.events])
+
+    def test_prometheus(self):
+        aggregator = instrumentation.Aggregator()
+        aggregator(instrumentation.Event('allocation', 0.5, 3,
+                                         {'filled': 2, 'fill_rate': 0.5}))
+        aggregator(instrumentation.Event('allocation', 1.5, 5,
+                                         {'filled': 1, 'fill_rate': 1.0}))
+        text = aggregator.prometheus()
+        for line in [
+                'timeslot_lottery_operation_seconds_sum'
+                '{operation="allocation"} 2.0',
+                'timeslot_lottery_operation_seconds_count'
+                '{operation="allocation"} 2.0',
+                '# TYPE timeslot_lottery_filled_total counter',
+                'timeslot_lottery_filled_total{operation="allocation"} 3.0',
+                'timeslot_lottery_queries_total{operation="allocation"} 8.0',
+                '# TYPE timeslot_lottery_fill_rate gauge',
+                'timeslot_lottery_fill_rate{operation="allocation"} 1.0']:
+            self.assertIn(line + '\n', text)
+
+
+class TestExport(TestCase):
+    def setUp(self):
+        self.tmpl = Template.objects.create(
+            slug='test', slots={1: ['10:00', '12:00']})
+        self.week = self.tmpl.create_new_week((2010, 1))
+        self.users = [User.objects.create(username='user_{}'.format(i))
+                      for i in range(3)]
+        s1, s2 = self.week.slots.all()
+        s1.bidders.add(*self.users)
+        s2.winner = self.users[1]
+        s2.save()
+        self.slots = [s1, s2]
+
+    def test_rows(self):
+        s1, s2 = self.slots
+        rows = list(export.rows(self.tmpl, chunk_size=1))
+
+        self.assertEqual([s1.pk, s2.pk], [row['slot_id'] for row in rows])
+        self.assertEqual(['user_0', 'user_1', 'user_2'], rows[0]['bidders'])
+        self.assertEqual(([], ['user_1']),
+                         (rows[0]['winners'], rows[1]['winners']))
+        self.assertEqual([1, 1], [row['capacity'] for row in rows])
+        self.assertEqual([], rows[1]['bidder_ids'])
+
+    def test_rows_keep_names_with_their_ids_across_chunks(self):
+        s1, s2 = self.slots
+        s2.bidders.add(self.users[2], self.users[0])
+        s1.winners.add(self.users[2])
+        names = dict((u.pk, u.username) for u in self.users)
+
+        rows = list(export.rows(self.tmpl, chunk_size=1))
+
+        self.assertEqual(2, len(rows))
+        for row in rows:
+            self.assertEqual([names[pk] for pk in row['bidder_ids']],
+                             row['bidders'])
+            self.assertEqual([names[pk] for pk in row['winner_ids']],
+                             row['winners'])
+        self.assertEqual(['user_0', 'user_2'], sorted(rows[1]['bidders']))
+        self.assertEqual(['user_2'], rows[0]['winners'])
+
+    def test_csv(self):
+        s1, s2 = self.slots
+        lines = list(export.export(self.tmpl, 'csv'))
+
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[0].startswith('year,week_no,status,slot_id'))
+        self.assertTrue(lines[1].endswith(
+            ',,,{} {} {},user_0 user_1 user_2\r\n'.format(
+                *[u.pk for u in self.users])))
+        self.assertIn(',1,{},user_1,,'.format(self.users[1].pk), lines[2])
+
+    def test_command_jsonl(self):
+        out = StringIO()
+        call_command('export_history', 'test', format='jsonl', stdout=out)
+
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([2010, 2010], [row['year'] for row in rows])
+        self.assertEqual([u.pk for u in self.users], rows[0]['bidder_ids'])
+
+    def test_view_streams(self):
+        request = RequestFactory().get('/')
+        request.user = User.objects.create(username='staff', is_staff=True)
+
+        response = views.export_history(request, 'test', 'jsonl')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(2, len(b''.join(response.streaming_content)
+                                .splitlines()))
+
+
+class TestAdmin(TestCase):
+    def setUp(self):
+        self.tmpl = Template.objects.create(
+            slug='test', slots={1: ['10:00', '12:00']})
+        self.weeks = [self.tmpl.create_new_week((2010, week_no))
+                      for week_no in (1, 2)]
+        self.users = [
+            User.objects.create(username='user_{}'.format(i),
+                                email='user_{}@example.com'.format(i))
+            for i in range(3)]
+        for week in self.weeks:
+            for slot in week.slots.all():
+                slot.bidders.add(*self.users)
+        self.request = RequestFactory().get('/')
+        self.request.user = User.objects.create(username='staff',
+                                                is_staff=True)
+        self.request._messages = CookieStorage(self.request)
+        self.week_admin = lottery_admin.WeekAdmin(Week, admin.site)
+
+    def test_annotated_counts(self):
+        with self.assertNumQueries(1):
+            weeks = list(self.week_admin.get_queryset(self.request)
+                         .order_by('week_no'))
+        self.assertEqual([(2, 6), (2, 6)],
+                         [(w.num_slots, w.num_bids) for w in weeks])
+        slots = (lottery_admin.SlotAdmin(Slot, admin.site)
+                 .get_queryset(self.request))
+        self.assertEqual(set([3]), set(slot.num_bids for slot in slots))
+
+    def test_slot_winners_are_read_only(self):
+        slot_admin = lottery_admin.SlotAdmin(Slot, admin.site)
+        form = slot_admin.get_form(self.request)
+        self.assertIn('winner', form.base_fields)
+        self.assertNotIn('winners', form.base_fields)
+
+    def test_close_and_notify_actions(self):
+        queryset = Week.objects.filter(week_no=1)
+        self.week_admin.close_weeks(self.request, queryset)
+
+        self.assertEqual([Week.STATUS.closed, Week.STATUS.new],
+                         [w.status for w in Week.objects.order_by('week_no')])
+
+        with self.assertNumQueries(1):
+            self.week_admin.notify_winners(self.request, queryset)
+        self.assertEqual(2, len(mail.outbox))
+
+
+@override_settings(TIMESLOT_LOTTERY_REPLICA='replica')
+class TestRouter(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = routers.LotteryRouter()
+        self.user = User.objects.create(username='user_1')
+
+    def test_reads_and_writes(self):
+        self.assertEqual('replica', self.router.db_for_read(Week))
+        self.assertEqual(None, self.router.db_for_read(User))
+        self.assertEqual('default', self.router.db_for_write(Week))
+        with routers.primary():
+            self.assertEqual('default', self.router.db_for_read(Slot))
+        self.assertEqual('replica', self.router.db_for_read(Slot))
+        with self.settings(TIMESLOT_LOTTERY_REPLICA=None):
+            self.assertEqual(None, self.router.db_for_read(Week))
+
+    def test_close_reads_from_primary(self):
+        tmpl = Template.objects.create(slug='test', slots={1: ['10:00']})
+        week = tmpl.create_new_week((2010, 1))
+        on_primary = []
+
+        def record(event):
+            on_primary.append((event.name, routers.on_primary()))
+        instrumentation.register(record)
+        self.addCleanup(instrumentation.unregister, record)
+        week.close()
+
+        self.assertIn(('allocation', True), on_primary)
+        self.assertEqual(set([True]), set(p for _, p in on_primary))
+        self.assertFalse(routers.on_primary())
+
+    def test_user_pinned_after_bidding(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        middleware = routers.PinnedUserMiddleware()
+
+        middleware.process_request(request)
+        self.assertEqual('replica', self.router.db_for_read(Week))
+        PendingBid.objects.submit(
+            Template.objects.create(slug='test').create_new_week((2010, 1)),
+            self.user, [])
+        self.assertEqual('default', self.router.db_for_read(Week))
+        middleware.process_response(request, None)
+        self.assertEqual('replica', self.router.db_for_read(Week))
+
+        # Pinned in the next request too, until the pin expires
+        middleware.process_request(request)
+        self.assertEqual('default', self.router.db_for_read(Week))
+        middleware.process_response(request, None)
+        cache.clear()
+        middleware.process_request(request)
+        self.assertEqual('replica', self.router.db_for_read(Week))
+        middleware.process_response(request, None)
+
+
+class TestWinCount(TestCase):
+    def setUp(self):
+        self.tmpl = Template.objects.create(slug='test', slots={1:['10:00']})
+        self.week = self.tmpl.create_new_week((2010, 1))
+        self.u1 = User.objects.create(username='user_1')
+        self.u2 = User.objects.create(username='user_2')
+
+    def wins(self):
+        return WinCount.objects.totals([self.u1.pk, self.u2.pk])
+
+    def test_slot_save_moves_win(self):
+        slot = Slot.objects.create(
+            week=self.week, time=timezone.now(), winner=self.u1)
+        self.assertEqual({self.u1.pk: 1}, self.wins())
+
+        slot.winner = self.u2
+        slot.save()
+        self.assertEqual({self.u1.pk: 0, self.u2.pk: 1}, self.wins())
+
+        slot.delete()
+        self.assertEqual({self.u1.pk: 0, self.u2.pk: 0}, self.wins())
+
+    def test_fill_slots_counts_wins(self):
+        self.week.slots.get().bidders.add(self.u1)
+        self.week.fill_slots()
+        self.assertEqual({self.u1.pk: 1}, self.wins())
+
+    def test_rebuild(self):
+        Slot.objects.create(
+            week=self.week, time=timezone.now(), winner=self.u1)
+        Slot.winners.through.objects.filter(user=self.u1).update(user=self.u2)
+
+        call_command('rebuild_win_counts', stdout=StringIO())
+
+        self.assertEqual({self.u2.pk: 1}, self.wins())
+
+
 class TestEmail(TestCase):
     def setUp(self):
         tmpl = Template.objects.create(
@@ -220,3 +1595,52 @@ class TestEmail(TestCase):
         txt, html = views._create_winner_email_body(self.users[0],
                                                     self.slots[0])
         self.assertIn('You got slot ', txt)
+
+    def test_notify_week_winners(self):
+        s1, s2, s3 = self.slots
+        u1 = self.users[0]
+        u1.email = 'user_1@example.com'
+        u1.save()
+        u2 = User.objects.create(username='user_2', email='u2@example.com')
+        u3 = User.objects.create(username='user_3')
+        for slot, user in zip(self.slots, [u1, u2, u3]):
+            slot.winner = user
+            slot.save()
+
+        week = Week.objects.get(pk=self.week.pk)
+        with self.assertNumQueries(2):
+            sent = notifications.notify_week_winners(week)
+
+        self.assertEqual(2, sent)
+        self.assertEqual(
+            [['u2@example.com'], ['user_1@example.com']],
+            sorted(msg.to for msg in mail.outbox))
+        self.assertIn('2010-1', mail.outbox[0].subject)
+
+    def test_send_messages_retries(self):
+        class FlakyConnection(object):
+            def __init__(self):
+                self.failures = 1
+                self.sent = []
+
+            def open(self):
+                pass
+
+            def close(self):
+                pass
+
+            def send_messages(self, messages):
+                if self.failures:
+                    self.failures -= 1
+                    raise smtplib.SMTPServerDisconnected()
+                self.sent.extend(messages)
+                return len(messages)
+
+        connection = FlakyConnection()
+        messages = [mail.EmailMessage('Hi', '', to=['a@example.com'])] * 3
+
+        sent = notifications.send_messages(
+            messages, connection, batch_size=2, backoff=0)
+
+        self.assertEqual(3, sent)
+        self.assertEqual(3, len(connection.sent))
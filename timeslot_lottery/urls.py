@@ -2,10 +2,16 @@ from django.conf.urls import patterns
 from django.conf.urls import url
 
 
+WEEK = r'^(?P<template_slug>[\w-]+)/(?P<year>\d{4})-(?P<week_no>\d{2})/'
+
 urlpatterns = patterns('timeslot_lottery.views',
     url(r'^$', 'home', name='home'),
+    url(r'^metrics/$', 'metrics', name='metrics'),
     url(r'^(?P<template_slug>[\w-]+)/$',
         'template_detail', name='template_detail'),
-    url(r'^(?P<template_slug>[\w-]+)/(?P<year>\d{4})-(?P<week_no>\d{2})/$',
-        'week_detail', name='week_detail'),
+    url(r'^(?P<template_slug>[\w-]+)/export\.(?P<format>csv|jsonl)$',
+        'export_history', name='export_history'),
+    url(WEEK + r'$', 'week_detail', name='week_detail'),
+    url(WEEK + r'bids/$', 'week_bids', name='week_bids'),
+    url(WEEK + r'results/$', 'week_results', name='week_results'),
 )
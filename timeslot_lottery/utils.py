@@ -1,12 +1,38 @@
 import datetime
 
+from django.utils.lru_cache import lru_cache
+
+
+@lru_cache(maxsize=256)
+def iso_year_start_ordinal(iso_year):
+    "The proleptic gregorian ordinal of the first day of the given ISO year"
+    fourth_jan = datetime.date(iso_year, 1, 4)
+    return fourth_jan.toordinal() - fourth_jan.weekday()
+
 def iso_year_start(iso_year):
     "The gregorian calendar date of the first day of the given ISO year"
-    fourth_jan = datetime.date(iso_year, 1, 4)
-    delta = datetime.timedelta(fourth_jan.isoweekday()-1)
-    return fourth_jan - delta
+    return datetime.date.fromordinal(iso_year_start_ordinal(iso_year))
+
+def iso_weeks_in_year(iso_year):
+    "Number of weeks in the given ISO year, 52 or 53"
+    return (iso_year_start_ordinal(iso_year + 1) -
+            iso_year_start_ordinal(iso_year)) // 7
 
 def iso_to_gregorian(iso_year, iso_week, iso_day):
     "Gregorian calendar date for the given ISO year, week and day"
-    year_start = iso_year_start(iso_year)
-    return year_start + datetime.timedelta(days=iso_day-1, weeks=iso_week-1)
+    return datetime.date.fromordinal(
+        _iso_ordinal(iso_year, iso_week, iso_day))
+
+def iso_weeks_to_gregorian(year_weeks):
+    "Gregorian dates of the mondays of many (ISO year, ISO week) tuples"
+    return [datetime.date.fromordinal(_iso_ordinal(year, week, 1))
+            for year, week in year_weeks]
+
+def _iso_ordinal(iso_year, iso_week, iso_day):
+    if not 1 <= iso_day <= 7:
+        raise ValueError("ISO day {} is not in 1..7".format(iso_day))
+    if not 1 <= iso_week <= iso_weeks_in_year(iso_year):
+        raise ValueError("ISO year {} has no week {}"
+                         .format(iso_year, iso_week))
+    return (iso_year_start_ordinal(iso_year) +
+            (iso_week - 1) * 7 + iso_day - 1)
@@ -1,82 +1,287 @@
-from django.core.mail import EmailMultiAlternatives
+import calendar
+import json
+import re
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.cache import cache
 from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render
-from django.template import Context
-from django.template.loader import get_template
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.utils.http import parse_etags
+from django.utils.http import parse_http_date_safe
+from django.utils.http import quote_etag
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import require_http_methods
 
+from timeslot_lottery import caching
+from timeslot_lottery import export
+from timeslot_lottery import instrumentation
+from timeslot_lottery import notifications
+from timeslot_lottery.models import CACHE_TIMEOUT
+from timeslot_lottery.models import CloseResult
+from timeslot_lottery.models import PendingBid
+from timeslot_lottery.models import WEEKS_CACHE_NAME
 from timeslot_lottery.models import Template
 from timeslot_lottery.models import Week
+from timeslot_lottery.models import bid_storage
+from timeslot_lottery.models import user_cache_name
+
+
+WEEKS_PER_PAGE = 20
 
 
 def home(request):
-    pass
+    user = request.user
+    year, week_no = timezone.now().isocalendar()[:2]
+    key = caching.make_key(user_cache_name(user), 'home',
+                           caching.version(WEEKS_CACHE_NAME), year, week_no)
+    weeks_html = cache.get(key)
+    if weeks_html is None:
+        weeks_html = render_to_string('timeslot_lottery/home_weeks.html', {
+            'weeks': Week.objects.for_user(user, (year, week_no)),
+            'user': user,
+        })
+        cache.set(key, weeks_html, CACHE_TIMEOUT)
+    return render(request, 'timeslot_lottery/home.html', {
+        'weeks_html': mark_safe(weeks_html),
+    })
 
 def week_detail(request, template_slug, year, week_no):
+    """
+    The slots of a week, for bidding while it's open
+
+    A closed week is shown from the results stored when it was closed,
+    with conditional GET support.
+    """
     user = request.user
     try:
-        week = Week.objects.get(template__slug=template_slug,
-                                year=year, week_no=week_no)
+        week = (Week.objects.select_related('template', 'close_result')
+                .get(template__slug=template_slug,
+                     year=year, week_no=week_no))
     except Week.DoesNotExist:
         if not user.is_staff:
             raise Http404("Week not found")
         template = Template.objects.get(slug=template_slug)
-        week = template.create_new_week((year, week_no))
-    slots = week.slots.all()
-    has_bid = user.slots_bid_for.filter(week=week).exists()
+        try:
+            week = template.create_new_week((year, week_no))
+        except ValueError:
+            raise Http404("No such week")
+    if request.method == 'POST' and week.status == Week.STATUS.closed:
+        return HttpResponse("The week is closed", status=409)
+    close_result = _close_result(week)
+    if close_result is not None:
+        return _conditional(
+            request, week,
+            lambda: _render_week(request, week, close_result.slots(user)),
+            user)
     if request.method == 'POST':
         slot_ids_bid_for = []
         for key, value in request.POST.items():
             if key.startswith('slot-'):
                 slot_ids_bid_for.append(int(key[len('slot-'):]))
-        for slot in slots:
-            if slot.id in slot_ids_bid_for:
-                slot.bidders.add(user)
-            else:
-                slot.bidders.remove(user)
+        week.set_bids(user, slot_ids_bid_for)
+    slots = bid_storage().with_bid_counts(
+        week.slots.prefetch_related('winners'), week.pk)
+    bid_slot_ids = week.bid_slot_ids(user)
+    for slot in slots:
+        slot.has_user_bid = slot.pk in bid_slot_ids
+        slot.winner_list = slot.winners.all()
+    return _render_week(request, week, slots)
+
 
+def _render_week(request, week, slots):
     return render(request, 'timeslot_lottery/week_detail.html', {
         'slots': slots,
         'week': week,
         'user': request.user,
-        'has_bid': has_bid,
+        'has_bid': any(slot.has_user_bid for slot in slots),
     })
 
 
+@require_http_methods(['GET', 'POST'])
+def week_bids(request, template_slug, year, week_no):
+    """
+    The user's bids for a week as JSON, {"slots": [slot ids]}
+
+    POSTing the same JSON replaces the bids.  They are validated against
+    the cached slot ids of the week and buffered as a `PendingBid`, so
+    the response doesn't wait for the slots to be written.
+    """
+    user = request.user
+    if not user.is_authenticated():
+        return JsonResponse({'error': "Log in to bid"}, status=403)
+    week = get_object_or_404(Week.objects.select_related('close_result'),
+                             template__slug=template_slug,
+                             year=year, week_no=week_no)
+    if request.method == 'POST':
+        try:
+            slot_ids = json.loads(request.body.decode('utf-8'))['slots']
+            if not isinstance(slot_ids, list):
+                raise TypeError
+            slot_ids = set(int(slot_id) for slot_id in slot_ids)
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({'error': "Expected {\"slots\": [ids]}"},
+                                status=400)
+        if week.status == Week.STATUS.closed:
+            return JsonResponse({'error': "The week is closed"},
+                                status=409)
+        invalid = slot_ids - week.slot_id_set()
+        if invalid:
+            return JsonResponse({'error': "Unknown slots",
+                                 'invalid': sorted(invalid)}, status=400)
+        PendingBid.objects.submit(week, user, slot_ids)
+        return JsonResponse({'slots': sorted(slot_ids)}, status=202)
+    close_result = _close_result(week)
+    if close_result is not None:
+        return _conditional(request, week, lambda: JsonResponse({
+            'slots': [slot.pk for slot in close_result.slots(user)
+                      if slot.has_user_bid],
+        }), user)
+    return JsonResponse({'slots': sorted(week.bid_slot_ids(user))})
+
+
+@require_http_methods(['GET', 'HEAD'])
+def week_results(request, template_slug, year, week_no):
+    """
+    The slots and winners of a closed week as JSON
+    """
+    week = get_object_or_404(Week.objects.select_related('close_result'),
+                             template__slug=template_slug,
+                             year=year, week_no=week_no)
+    close_result = _close_result(week)
+    if close_result is None:
+        raise Http404("The week isn't closed")
+
+    def results():
+        return JsonResponse({
+            'year': week.year,
+            'week_no': week.week_no,
+            'slots': [{
+                'id': slot['id'],
+                'time': slot['time'],
+                'capacity': slot['capacity'],
+                'num_bids': len(slot['bidders']),
+                'winners': [name for _, name in slot['winners']],
+            } for slot in close_result.final_results()['slots']],
+        })
+    return _conditional(request, week, results)
+
+
+def _close_result(week):
+    "The close result of a closed week, or None"
+    if week.status != Week.STATUS.closed:
+        return None
+    try:
+        return week.close_result
+    except CloseResult.DoesNotExist:
+        return None
+
+
+def _conditional(request, week, make_response, user=None):
+    """
+    A closed week's response with validators, or 304 Not Modified
+
+    A closed week doesn't change unless it's saved again, so its
+    `modified` time, and the user for per-user responses, identify the
+    response.  `make_response` is only called if the client doesn't
+    have it already.
+    """
+    modified = week.modified
+    etag = '{}-{}'.format(week.pk, modified.strftime('%Y%m%d%H%M%S%f'))
+    if user is not None:
+        etag += '-{}'.format(user.pk or 0)
+    last_modified = calendar.timegm(modified.utctimetuple())
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        not_modified = etag in etags or '*' in etags
+    elif if_modified_since:
+        not_modified = last_modified <= if_modified_since
+    else:
+        not_modified = False
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = make_response()
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(last_modified)
+    if user is not None:
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Cookie'])
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+    return response
+
+
 def template_detail(request, template_slug):
     template = get_object_or_404(Template, slug=template_slug)
+    year, week_no = timezone.now().isocalendar()[:2]
+    before = request.GET.get('before', '')
+    if before and not re.match(r'^\d{4}-\d{2}$', before):
+        raise Http404("Bad week")
+    is_staff = request.user.is_staff
+    key = caching.make_key(template.cache_name, 'weeks',
+                           year, week_no, is_staff, before)
+    weeks_html = cache.get(key)
+    if weeks_html is None:
+        weeks = template.weeks_before(before and before.split('-'),
+                                      WEEKS_PER_PAGE + 1)
+        next_before = None
+        if len(weeks) > WEEKS_PER_PAGE:
+            weeks = weeks[:WEEKS_PER_PAGE]
+            next_before = '{}-{:02d}'.format(weeks[-1].year,
+                                             weeks[-1].week_no)
+        weeks_html = render_to_string(
+            'timeslot_lottery/template_weeks.html', {
+                'template': template,
+                'current_week': template.current_week((year, week_no)),
+                'year': year,
+                'week_no': '{:02d}'.format(week_no),
+                'is_staff': is_staff,
+                'weeks': weeks,
+                'next_before': next_before,
+            })
+        cache.set(key, weeks_html, CACHE_TIMEOUT)
     return render(request, 'timeslot_lottery/template_detail.html', {
         'template': template,
+        'weeks_html': mark_safe(weeks_html),
     })
 
 
+@staff_member_required
+def export_history(request, template_slug, format):
+    template = get_object_or_404(Template, slug=template_slug)
+    response = StreamingHttpResponse(
+        export.export(template, format),
+        content_type=export.CONTENT_TYPES[format])
+    response['Content-Disposition'] = (
+        'attachment; filename="{}.{}"'.format(template.slug, format))
+    return response
+
+
+def metrics(request):
+    if not getattr(settings, 'TIMESLOT_LOTTERY_METRICS', False):
+        raise Http404("Metrics are not enabled")
+    return HttpResponse(instrumentation.aggregator.prometheus(),
+                        content_type='text/plain; version=0.0.4')
+
+
 # Utils
 
 def notify_week_winners(week, winner_slots=None):
-    if winner_slots is None:
-        winner_slots = week.slots.filter(winner__isnull=False)
-    for slot in winner_slots:
-        _send_winner_email(slot.winner, slot)
-
-def _send_winner_email(user, slot):
-    if not user.email:
-        return
-    text_body, html_body = _create_winner_email_body(user, slot)
-    title = "Got slot for {s.week.template} {s.week}".format(s=slot)
-    msg = EmailMultiAlternatives(title, text_body, "skriv@nynorsk.no",
-                                 [user.email])
-    msg.attach_alternative(html_body, 'text/html')
-    msg.send()
+    return notifications.notify_week_winners(week, winner_slots)
 
 def _create_winner_email_body(user, slot):
-    ctx = Context({
-        'slot': slot,
-        'template': slot.week.template,
-        'user': user,
-        'week': slot.week,
-   })
-    text_body = (
-        get_template('timeslot_lottery/emails/winner.txt').render(ctx))
-    html_body = (
-        get_template('timeslot_lottery/emails/winner.html').render(ctx))
-    return text_body, html_body
+    return notifications.WinnerEmails().render(user, slot)